@@ -0,0 +1,214 @@
+# Time every stage of the scripts on a (synthetic) run, to compare performance between commits
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from contacts import LEGACY_RADIUS, STORE_NAME, load_store, write_store
+from filter_contacts import DEFAULT_FORBIDDEN, calculate_contact, load_contact_files, load_forbidden, filter_contacts
+from contact_analysis import load_scores, rank_models, rank_table, residue_frequencies
+from prepare_submission import get_models, select_models, match, capri51_rechain, write_submission
+from haddock_files import read_file_nam, read_file_list
+from run_archive import run_file_exists
+from structure import Structure
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'capri_51_183.brk')
+
+
+def _memory_run(func, conn):
+    """ Run a stage under tracemalloc, sends back its peak traced memory and the peak RSS of the workers it started """
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # in KB on Linux, the workers are joined by the stage so they are accounted for
+    conn.send((peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+    conn.close()
+
+
+def measure_memory(func):
+    """ Peak memory of a stage, in MB
+
+    The stage runs in a forked process: tracemalloc only sees the Python allocations of the process running the stage,
+    the memory of the pool workers is their peak RSS, which is per stage only in a fresh process.
+
+    :param func: Function running the stage, without arguments
+    :type func: function
+    :return: Peak traced memory of the process running the stage, largest peak RSS of its workers (0 without workers)
+    :rtype: tuple
+    """
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_memory_run, args=(func, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        peak, workers_kb = parent_conn.recv()
+    except EOFError:
+        raise RuntimeError('The memory measurement of the stage failed') from None
+    finally:
+        process.join()
+    return peak / 1024 / 1024, workers_kb / 1024
+
+
+def measure(stage, func, n_items, repeat=1, memory=True):
+    """ Time a stage and measure its peak memory
+
+    The peak memory is taken from an extra run, see measure_memory, so the tracing does not slow down the timed runs.
+
+    :param stage: Name of the stage
+    :param func: Function running the stage, without arguments
+    :param n_items: Number of items (models) the stage processes
+    :param repeat: Number of timed runs, the fastest one is reported
+    :param memory: Whether the peak memory is measured
+    :type stage: string
+    :type func: function
+    :type n_items: int
+    :type repeat: int
+    :type memory: bool
+    :return: The result of func and the measurements of the stage
+    :rtype: tuple
+    """
+    # the messages of the stages themselves are muted while they are measured
+    logging.disable(logging.WARNING)
+    try:
+        wall = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            wall.append(time.perf_counter() - start)
+
+        peak_mb = workers_peak_mb = None
+        if memory:
+            peak_mb, workers_peak_mb = measure_memory(func)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    wall_s = min(wall)
+    metrics = {'stage': stage, 'items': n_items, 'wall_s': wall_s,
+               'items_per_s': n_items / wall_s if wall_s else None, 'peak_mb': peak_mb,
+               'workers_peak_rss_mb': workers_peak_mb}
+    logging.info('%-20s %8i items %10.3f s %12.1f items/s %10s MB %10s MB workers', stage, n_items, wall_s,
+                 metrics['items_per_s'] or 0, f'{peak_mb:.2f}' if memory else '-',
+                 f'{workers_peak_mb:.2f}' if memory else '-')
+    return result, metrics
+
+
+def git_commit():
+    """ Commit of the scripts being benchmarked, None outside of a git checkout """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(rundir, template_f, sample=100, top=100, nproc=1, repeat=1, memory=True):
+    """ Benchmark every stage of filter_contacts, contact_analysis and prepare_submission on a run
+
+    The contacts are read from the .contacts files of the run, or else from its contact store, and written to a
+    contact store in a temporary directory: nothing is written into the run.
+
+    :param rundir: Run directory, as written by synthetic_run.py
+    :param template_f: CAPRI template
+    :param sample: Number of it0 models used to time the contact calculation
+    :param top: Number of ranked models used in the contact analysis
+    :param nproc: Number of processors used by the stages that support it
+    :param repeat: Number of timed runs of each stage
+    :param memory: Whether the peak memory of each stage, and of its workers, is measured
+    :type rundir: string
+    :type template_f: string
+    :type sample: int
+    :type top: int
+    :type nproc: int
+    :type repeat: int
+    :type memory: bool
+    :return: Measurements of every stage
+    :rtype: list
+    """
+    it0 = f'{rundir}/structures/it0'
+    stages = []
+
+    def timed(stage, func, n_items):
+        result, metrics = measure(stage, func, n_items, repeat, memory)
+        stages.append(metrics)
+        return result
+
+    names = read_file_nam(f'{it0}/file.nam')
+
+    sample_files = [f'{it0}/{pdb}' for pdb in names[:sample]]
+    timed('calculate_contact', lambda: [calculate_contact(pdb_f) for pdb_f in sample_files], len(sample_files))
+
+    run_store_f = f'{it0}/{STORE_NAME}'
+    with tempfile.TemporaryDirectory() as work_dir:
+        store_f = f'{work_dir}/{STORE_NAME}'
+        if run_file_exists(f"{it0}/{names[0].replace('.pdb', '.contacts')}"):
+            names, table = timed('load_contact_files', lambda: load_contact_files(rundir, nproc), len(names))
+        elif run_file_exists(run_store_f):
+            names, table = timed('load_run_store', lambda: load_store(run_store_f, LEGACY_RADIUS), len(names))
+        else:
+            raise FileNotFoundError(f'No .contacts files nor contact store in {it0}')
+        timed('write_store', lambda: write_store(store_f, names, table, LEGACY_RADIUS), len(names))
+        names, table = timed('load_contacts', lambda: load_store(store_f, 4.9), len(names))
+
+        forbidden = load_forbidden(DEFAULT_FORBIDDEN)
+        filtered = timed('filter_contacts', lambda: filter_contacts(names, table, forbidden, .2), len(names))
+
+        def contact_analysis():
+            haddockscore_dic = load_scores(f'{it0}/file.list')
+            top_models = rank_models([f'{it0}/{pdb}' for pdb in filtered], haddockscore_dic, top)
+            return residue_frequencies(rank_table(names, table, top_models), [top], len(top_models))
+        timed('contact_analysis', contact_analysis, len(filtered))
+
+    def selection():
+        columns = ['pdb', 'single_structure_ranking', 'overall_cluster_ranking', 'internal_cluster_ranking']
+        return select_models(pd.DataFrame(get_models(rundir), columns=columns))
+    n_water = len(read_file_list(f'{rundir}/structures/it1/water/file.list'))
+    selected = timed('get_models', selection, n_water)
+    selected_pdbs = [f'{rundir}/structures/it1/water/{pdb}' for pdb in selected]
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        template = Structure.from_pdb(template_f)
+        matched = timed('match', lambda: match(selected_pdbs, template, output_dir, capri51_rechain, nproc),
+                        len(selected_pdbs))
+        header = [l for l in template.header if l.startswith(('HEADER', 'COMPND', 'SEQRES', 'REMARK'))]
+        timed('write_submission', lambda: write_submission(f'{output_dir}/submission.pdb', header, matched),
+              len(matched))
+
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_directory", help='Run to benchmark, for example one written by synthetic_run.py')
+    parser.add_argument("--template", help='Template provided by CAPRI', default=DEFAULT_TEMPLATE)
+    parser.add_argument("--sample", help='Number of it0 models used to time the contact calculation, default=100', type=int, default=100)
+    parser.add_argument("--top", help='Number of ranked models used in the contact analysis, default=100', type=int, default=100)
+    parser.add_argument("--np", help='Number of processors to use', type=int, default=1)
+    parser.add_argument("--repeat", help='Number of timed runs of each stage, the fastest is reported, default=1', type=int, default=1)
+    parser.add_argument("--no_memory", help='Do not measure the peak memory of each stage', action='store_true')
+    parser.add_argument("--output", help='JSON report, default=benchmark.json', default='benchmark.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO',
+                        format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+    results = run_benchmark(args.run_directory, args.template, args.sample, args.top, args.np, args.repeat,
+                            not args.no_memory)
+
+    report = {'run_directory': os.path.abspath(args.run_directory), 'commit': git_commit(),
+              'python': platform.python_version(), 'numpy': np.__version__, 'np': args.np, 'stages': results}
+    logging.info('Writing the benchmark report to %s', args.output)
+    with open(args.output, 'w') as out_fh:
+        json.dump(report, out_fh, indent=2)
+
+    # done
@@ -0,0 +1,219 @@
+# Cluster the models of a run by their fraction of common contacts (FCC), as HADDOCK's analysis does
+#  with clust_meth FCC, and write a cluster.out that prepare_submission.py can read
+import argparse
+import logging
+import os
+import numpy as np
+
+from contact_cache import DEFAULT_CACHE_DIR
+from contacts import DEFAULT_RADIUS, STORE_NAME, load_store, within_cutoff
+from haddock_files import read_file_list
+from pipeline import calculate_contacts
+from profiling import Profiler
+from run_archive import open_run_file, run_file_exists
+
+# HADDOCK's defaults for clust_meth FCC
+DEFAULT_CUTOFF = .6
+DEFAULT_STRICTNESS = .75
+DEFAULT_MIN_SIZE = 4
+STAGE_DIRS = {'it0': 'structures/it0', 'it1': 'structures/it1', 'water': 'structures/it1/water'}
+
+
+def _gather(values, starts, lengths):
+    """Concatenate the slices values[start:start + length], without a Python loop."""
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+    return values[positions]
+
+
+def contact_matrix(n_models, table):
+    """Sparse model x contact-pair matrix of a contact table.
+
+    Returns the matrix as CSR (indptr, contact ids), its transpose as CSC (column pointers, models) and where
+    every CSR entry is in the CSC arrays.
+    """
+    # a contact pair is a (chain_i, resnum_i, chain_j, resnum_j) residue pair, packed into a single integer
+    key = ((table['chain_i'].astype(np.int64) << 56) | ((table['resnum_i'].astype(np.int64) & 0xFFFFF) << 36)
+           | (table['chain_j'].astype(np.int64) << 20) | (table['resnum_j'].astype(np.int64) & 0xFFFFF))
+    pairs, contact_ids = np.unique(key, return_inverse=True)
+    n_pairs = max(len(pairs), 1)
+
+    # one entry per (model, contact pair), sorted by model
+    entry = np.sort(table['model'].astype(np.int64) * n_pairs + contact_ids.ravel(), kind='stable')
+    entry = entry[np.concatenate([entry[:1] == entry[:1], entry[1:] != entry[:-1]])]
+    rows, cols = entry // n_pairs, entry % n_pairs
+    indptr = np.searchsorted(rows, np.arange(n_models + 1))
+
+    # models stay sorted inside every column
+    order = np.argsort(cols, kind='stable')
+    col_ptr = np.searchsorted(cols[order], np.arange(len(pairs) + 1))
+    csc_pos = np.empty(len(order), dtype=np.int64)
+    csc_pos[order] = np.arange(len(order))
+    return indptr, cols, col_ptr, rows[order], csc_pos
+
+
+def fcc_neighbours(n_models, table, cutoff=DEFAULT_CUTOFF, strictness=DEFAULT_STRICTNESS, block_size=2 ** 22):
+    """Find the FCC neighbours of every model, returns the (model, neighbour) pairs as two arrays.
+
+    The common contacts of every pair of models are the product of the model x contact-pair matrix with its
+    transpose. The product is symmetric, so only its upper triangle is computed, by blocks of models to keep the
+    memory bounded by block_size. As in HADDOCK, j is a neighbour of i when FCC(i, j) = common / contacts of i
+    >= cutoff and FCC(j, i) >= cutoff * strictness.
+    """
+    indptr, cols, col_ptr, col_rows, csc_pos = contact_matrix(n_models, table)
+    n_contacts = np.diff(indptr)
+    col_rows = col_rows.astype(np.int32)
+    # the models after the model of an entry in its column, the work of a model is the sum over its entries
+    entry_lengths = col_ptr[cols + 1] - csc_pos - 1
+    work = np.concatenate([[0], np.cumsum(entry_lengths)])[indptr]
+    max_rows = max(1, block_size // max(n_models, 1))
+
+    sources, targets = [], []
+    start = 0
+    while start < n_models:
+        end = np.searchsorted(work, work[start] + block_size, side='right') - 1
+        end = max(start + 1, min(start + max_rows, end))
+        block = np.arange(start, end)
+        block_entries = slice(indptr[start], indptr[end])
+        lengths = entry_lengths[block_entries]
+        partners = _gather(col_rows, csc_pos[block_entries] + 1, lengths)
+        offsets = np.repeat(np.repeat(np.arange(len(block), dtype=np.int32) * n_models, n_contacts[block]), lengths)
+        common = np.bincount(offsets + partners, minlength=len(block) * n_models).reshape(len(block), -1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fcc_ij = common / n_contacts[block, None]
+            fcc_ji = common / n_contacts[None, :]
+        upper = np.arange(n_models)[None, :] > block[:, None]
+        i, j = np.nonzero(upper & (fcc_ij >= cutoff) & (fcc_ji >= cutoff * strictness))
+        sources += [block[i]]
+        targets += [j]
+        i, j = np.nonzero(upper & (fcc_ji >= cutoff) & (fcc_ij >= cutoff * strictness))
+        sources += [j]
+        targets += [block[i]]
+        start = end
+    empty = [np.empty(0, dtype=np.int64)]
+    return np.concatenate(sources + empty), np.concatenate(targets + empty)
+
+
+def greedy_clusters(n_models, sources, targets, min_size=DEFAULT_MIN_SIZE):
+    """HADDOCK's greedy FCC clustering, returns [(center, members)] in the order the clusters are made.
+
+    The model with the most unclustered neighbours (the best ranked one on ties) becomes the center of a cluster
+    with all of its unclustered neighbours, until no model has at least min_size - 1 of them left.
+    """
+    order = np.argsort(sources, kind='stable')
+    out_ptr, out_nb = np.searchsorted(sources[order], np.arange(n_models + 1)), targets[order]
+    order = np.argsort(targets, kind='stable')
+    in_ptr, in_nb = np.searchsorted(targets[order], np.arange(n_models + 1)), sources[order]
+
+    degree = np.bincount(sources, minlength=n_models)
+    clustered = np.zeros(n_models, dtype=bool)
+    clusters = []
+    while n_models:
+        free_degree = np.where(clustered, -1, degree)
+        center = int(np.argmax(free_degree))
+        if free_degree[center] < max(min_size - 1, 0):
+            break
+        neighbours = out_nb[out_ptr[center]:out_ptr[center + 1]]
+        members = np.concatenate([[center], neighbours[~clustered[neighbours]]])
+        clustered[members] = True
+        # the new members are no longer available as neighbours of the remaining models
+        in_lengths = in_ptr[members + 1] - in_ptr[members]
+        degree -= np.bincount(_gather(in_nb, in_ptr[members], in_lengths), minlength=n_models)
+        clusters.append((center, np.sort(members)))
+    return clusters
+
+
+def write_clusters(clusters, numbers, output_f):
+    """Write the clusters in the format of HADDOCK's cluster.out, models are given by their number."""
+    with open(output_f, 'w') as out_fh:
+        for cluster_id, (center, members) in enumerate(clusters, start=1):
+            out_fh.write(f'Cluster {cluster_id} -> {numbers[center]} ')
+            out_fh.write(''.join(f'{numbers[member]} ' for member in members.tolist()))
+            out_fh.write('\n')
+
+
+def load_stage_contacts(model_dir, pdb_list, nproc=1, contact_cutoff=4.9, cache_dir=None, profiler=None):
+    """Contacts of the models of a stage as (names, table), from its contact store when it has all of them."""
+    store_f = f'{model_dir}/{STORE_NAME}'
+    table = None
+    if run_file_exists(store_f):
+        try:
+            names, table = load_store(store_f, contact_cutoff)
+        except ValueError as err:
+            logging.warning('%s, calculating the contacts', err)
+
+    if table is not None:
+        model_idx = {name: idx for idx, name in enumerate(names)}
+        if all(pdb in model_idx for pdb in pdb_list):
+            logging.info('Reading the contacts from %s', store_f)
+            # renumber the rows of the store to the positions in pdb_list
+            new_idx = np.full(len(names), -1, dtype=np.int64)
+            new_idx[[model_idx[pdb] for pdb in pdb_list]] = np.arange(len(pdb_list))
+            row_idx = new_idx[table['model']]
+            selected = table[row_idx >= 0]
+            selected['model'] = row_idx[row_idx >= 0]
+            return list(pdb_list), selected
+        logging.warning('The contact store %s misses some of the models, calculating their contacts', store_f)
+
+    logging.info('Calculating contacts for %i PDBs using %i processors', len(pdb_list), nproc)
+    radius = max(DEFAULT_RADIUS, contact_cutoff)
+    names, table, failed_pdbs = calculate_contacts(model_dir, pdb_list, nproc, radius, cache_dir, profiler)
+    if failed_pdbs:
+        logging.warning('%i models failed and are not clustered', len(failed_pdbs))
+    return names, within_cutoff(table, contact_cutoff)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_directory", help='Location of the run')
+    parser.add_argument("--stage", help='Models to cluster, default=water', choices=sorted(STAGE_DIRS), default='water')
+    parser.add_argument("--models", help='Only cluster the models in this list (e.g. filtered-pdbs.list), one per line')
+    parser.add_argument("--cutoff", help=f'FCC cutoff, default={DEFAULT_CUTOFF}', type=float, default=DEFAULT_CUTOFF)
+    parser.add_argument("--strictness", help=f'Strictness of the reverse FCC, default={DEFAULT_STRICTNESS}', type=float, default=DEFAULT_STRICTNESS)
+    parser.add_argument("--min_size", help=f'Minimum cluster size, default={DEFAULT_MIN_SIZE}', type=int, default=DEFAULT_MIN_SIZE)
+    parser.add_argument("--np", help='Number of processors used to calculate the contacts', type=int, default=2)
+    parser.add_argument("--contact_cutoff", help='Distance cutoff in Angstrom used to define a contact', type=float, default=4.9)
+    parser.add_argument("--cache_dir", help=f'Contact cache shared between runs, default={DEFAULT_CACHE_DIR}', default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--output", help='cluster.out formatted output, default=cluster.out', default='cluster.out')
+    parser.add_argument("--profile", help='Write the time, memory and throughput of every stage to this JSON file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='DEBUG',
+                        format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    profiler = Profiler('cluster_fcc')
+    model_dir = f'{args.run_directory}/{STAGE_DIRS[args.stage]}'
+
+    # as in HADDOCK's cluster.out, models are numbered by their position in file.list
+    with profiler.stage('read_file_list') as stage:
+        numbers = {}
+        for number, (pdb, _) in enumerate(read_file_list(f'{model_dir}/file.list'), start=1):
+            numbers.setdefault(pdb, number)
+        pdb_list = list(numbers)
+        if args.models:
+            with open_run_file(args.models) as fh:
+                selected = set(os.path.basename(line.strip()) for line in fh if line.strip())
+            pdb_list = [pdb for pdb in pdb_list if pdb in selected]
+        stage['items'] = len(pdb_list)
+
+    with profiler.stage('contacts', len(pdb_list)):
+        names, table = load_stage_contacts(model_dir, pdb_list, args.np, args.contact_cutoff, args.cache_dir, profiler)
+
+    logging.info('Clustering %i models, FCC cutoff=%.2f strictness=%.2f min size=%i', len(names), args.cutoff,
+                 args.strictness, args.min_size)
+    with profiler.stage('fcc_neighbours', len(names)):
+        sources, targets = fcc_neighbours(len(names), table, args.cutoff, args.strictness)
+    with profiler.stage('clustering', len(names)):
+        clusters = greedy_clusters(len(names), sources, targets, args.min_size)
+    n_clustered = sum(len(members) for _, members in clusters)
+    logging.info('%i clusters, %i of %i models clustered', len(clusters), n_clustered, len(names))
+
+    logging.info('Writing the clusters to %s', args.output)
+    write_clusters(clusters, [numbers[pdb] for pdb in names], args.output)
+
+    if args.profile:
+        logging.info('Writing the profile to %s', args.profile)
+        profiler.write(args.profile)
+
+    # done
@@ -1,66 +1,194 @@
 import argparse
 import os
+import heapq
 import logging
+import numpy as np
+
+from haddock_files import read_file_list
+from run_archive import run_file_exists
+from profiling import Profiler
+from contacts import LEGACY_RADIUS, STORE_NAME, load_store, split_models, within_cutoff, parse_contact_file, build_table
+
+
+def load_scores(file_list):
+    """Load the haddock-scores of a file.list into a dictionary {PDB: score}."""
+    return dict(read_file_list(file_list))
+
+
+def rank_models(pdb_l, haddockscore_dic, top):
+    """Select the top models of a list by their haddock-score (lower is better), best first."""
+    scored = [(haddockscore_dic[os.path.basename(pdb)], idx, pdb) for idx, pdb in enumerate(pdb_l)
+              if os.path.basename(pdb) in haddockscore_dic]
+    if len(scored) < len(pdb_l):
+        logging.warning('%i models have no haddock-score and will be ignored', len(pdb_l) - len(scored))
+    return [pdb for _, _, pdb in heapq.nsmallest(top, scored)]
+
+
+def gather_contacts(ranked_pdbs, cutoff=4.9):
+    """Collect the contacts of ranked models closer than a cutoff into a single table, the model column is the rank.
+
+    Without a contact store, the legacy .contacts files of the models are read instead.
+    """
+    stores = {}
+    model_contacts = []
+    for rank, pdb in enumerate(ranked_pdbs):
+        # the contacts of all models of a run are in a single store, load it once per directory
+        store_f = os.path.join(os.path.dirname(pdb), STORE_NAME)
+        if store_f not in stores:
+            if run_file_exists(store_f):
+                stores[store_f] = split_models(*load_store(store_f, cutoff))
+            elif cutoff > LEGACY_RADIUS:
+                raise ValueError(f'No contact store in {os.path.dirname(pdb)}, the .contacts files have the contacts '
+                                 f'up to {LEGACY_RADIUS} A, they cannot answer a cutoff of {cutoff} A')
+            else:
+                logging.warning('Contact store for %s not found! expected: %s, reading the .contacts files', pdb,
+                                store_f)
+                stores[store_f] = None
+
+        if stores[store_f] is None:
+            contacts = parse_contact_file(pdb.replace('.pdb', '.contacts'))
+            if contacts is None:
+                logging.warning('No contact file for %s', pdb)
+                continue
+            model_contacts.append((rank, within_cutoff(contacts, cutoff) if cutoff < LEGACY_RADIUS else contacts))
+            continue
+
+        pdb_name = os.path.basename(pdb)
+        if pdb_name not in stores[store_f]:
+            logging.warning('Contacts for %s not found in %s', pdb, store_f)
+            continue
+        model_contacts.append((rank, stores[store_f][pdb_name]))
+    return build_table(model_contacts)
+
+
+def rank_table(names, table, ranked_pdbs):
+    """Select the contacts of ranked models from an in-memory contact table, the model column becomes the rank."""
+    model_idx = {name: idx for idx, name in enumerate(names)}
+    model_rank = np.full(len(names), -1, dtype=np.int64)
+    for rank, pdb in enumerate(ranked_pdbs):
+        pdb_name = os.path.basename(pdb)
+        if pdb_name not in model_idx:
+            logging.warning('Contacts for %s not found', pdb)
+            continue
+        model_rank[model_idx[pdb_name]] = rank
+
+    row_rank = model_rank[table['model']]
+    ranked = table[row_rank >= 0]
+    ranked['model'] = row_rank[row_rank >= 0]
+    return ranked[np.argsort(ranked['model'], kind='stable')]
+
+
+def residue_frequencies(table, tops, n_ranked):
+    """Count in how many of the top N models each residue is in contact for several N in a single pass.
+
+    The model column of the table is the rank, the counts of a threshold are the cumulative counts of
+    the previous one plus the residues of the models ranked in between, n_ranked is the number of
+    ranked models. Returns {top: {chain: (resnums, counts, fractions)}}.
+    """
+    model = np.concatenate([table['model'], table['model']]).astype(np.int64)
+    chain = np.concatenate([table['chain_i'], table['chain_j']]).astype(np.int64)
+    resnum = np.concatenate([table['resnum_i'], table['resnum_j']]).astype(np.int64)
+    # residue numbers can be negative, they are packed relative to the smallest one
+    offset = resnum.min() if len(resnum) else 0
+
+    # a residue counts once per model, no matter with how many partners, keys end up sorted by rank
+    key = np.sort((model << 40) | (chain << 32) | (resnum - offset))
+    key = key[np.concatenate([key[:1] == key[:1], key[1:] != key[:-1]])]
+    residues, residue_idx = np.unique(key & 0xFFFFFFFFFF, return_inverse=True)
+    rank_bounds = np.searchsorted(key >> 40, sorted(tops))
+
+    frequencies = {}
+    counts = np.zeros(len(residues), dtype=np.int64)
+    previous = 0
+    for top, bound in zip(sorted(tops), rank_bounds.tolist()):
+        counts += np.bincount(residue_idx[previous:bound], minlength=len(residues))
+        previous = bound
+        n_models = min(top, n_ranked) or 1
+        in_contact = np.nonzero(counts)[0]
+        frequencies[top] = {}
+        for chain_code in np.unique(residues[in_contact] >> 32).tolist():
+            sel = in_contact[(residues[in_contact] >> 32) == chain_code]
+            frequencies[top][chr(chain_code)] = ((residues[sel] & 0xFFFFFFFF) + offset, counts[sel],
+                                                 counts[sel] / n_models)
+    return frequencies
+
+
+def write_frequencies(frequencies, output_f):
+    """Write the frequency tables of every threshold as a single tab separated file."""
+    with open(output_f, 'w') as out_fh:
+        out_fh.write('top\tchain\tresnum\tcount\tfraction\n')
+        for top in sorted(frequencies):
+            for chain in sorted(frequencies[top]):
+                resnums, counts, fractions = frequencies[top][chain]
+                for resnum, count, fraction in zip(resnums.tolist(), counts.tolist(), fractions.tolist()):
+                    out_fh.write(f'{top}\t{chain}\t{resnum}\t{count}\t{fraction:.3f}\n')
+
+
+def write_restraints(chain_frequencies, output_f, min_fraction=0.):
+    """Write the residues in contact of every chain, one line per chain: chain and comma separated residues.
+
+    chain_frequencies are the frequencies of a single threshold, {chain: (resnums, counts, fractions)}, only
+    residues in contact in at least min_fraction of the models are written.
+    """
+    with open(output_f, 'w') as out_fh:
+        for chain in sorted(chain_frequencies):
+            resnums, _, fractions = chain_frequencies[chain]
+            selected = resnums[fractions >= min_fraction]
+            if len(selected):
+                out_fh.write(f"{chain}\t{','.join(map(str, selected.tolist()))}\n")
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("file_list", help='File containing the Haddock-scores for each PDB')
     parser.add_argument("input_pdblist", help='Filtered PDB List containing the full path of the PDB')
-    parser.add_argument("--top", help='After ranking, how many models should be considered when counting contacts, default=100', type=int, default=100)
+    parser.add_argument("--top", help='After ranking, how many models should be considered when counting contacts, several values can be given to analyse them in a single pass, default=100', type=int, nargs='+', default=[100])
+    parser.add_argument("--contact_cutoff", help='Distance cutoff in Angstrom used to define a contact, up to the radius the contacts were stored with', type=float, default=4.9)
+    parser.add_argument("--output", help='Per-residue contact frequency table, default=contact-frequencies.tsv', default='contact-frequencies.tsv')
+    parser.add_argument("--profile", help='Write the time, memory and throughput of every stage to this JSON file')
+    parser.add_argument("--cprofile", help='With --profile, dump the cProfile statistics of the contact gathering to this file')
     args = parser.parse_args()
 
     logging.basicConfig(level='DEBUG',
                         format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
                         datefmt='%d/%m/%Y %H:%M:%S')
 
-    # Load the haddock-scores
-    haddockscore_dic = {}
-    with open(args.file_list, 'r') as file_h:
-        for line in file_h.readlines():
-            haddock_score = line.split()[-2]
-            pdb_name = line.split()[0].split(':')[-1][:-1]
-            haddockscore_dic[pdb_name] = float(haddock_score)
+    profiler = Profiler('contact_analysis', args.cprofile if args.profile else None)
 
-    if len(haddockscore_dic) < args.top:
-        logging.warning('Your input contains less than %i models, all models will be used.', args.top)
-
-    top_models = sorted(haddockscore_dic)[:args.top]
+    # Load the haddock-scores
+    with profiler.stage('load_scores') as stage:
+        haddockscore_dic = load_scores(args.file_list)
+        stage['items'] = len(haddockscore_dic)
 
-    # Load the PDBs, note that here we are using it0 models
-    logging.info('Extracting contacts from the top %i models', len(top_models))
-    contacts = {}
     with open(args.input_pdblist, 'r') as fh:
-        for pdb in fh.readlines():
-            pdb = pdb[:-1]  # remove /n
-            pdb_name = pdb.split('/')[-1]
-            if pdb_name not in top_models:
-                continue
+        pdb_l = [pdb.rstrip('\n') for pdb in fh]
 
-            contact_file = pdb.replace('.pdb', '.contacts')
+    max_top = max(args.top)
+    if len(pdb_l) < max_top:
+        logging.warning('Your input contains less than %i models, all models will be used.', max_top)
 
-            if not os.path.isfile(contact_file):
-                logging.warning('Contact file for %s not found! expected: %s', pdb, contact_file)
+    with profiler.stage('rank_models', len(pdb_l)):
+        top_models = rank_models(pdb_l, haddockscore_dic, max_top)
 
-            with open(contact_file, 'r') as con_fh:
-                for line in con_fh.readlines():
-                    data = line.split()
-                    chain_i = str(data[1])
-                    chain_j = str(data[4])
-                    resnum_i = int(data[0])
-                    resnum_j = int(data[3])
-                    pair = resnum_i, resnum_j
-
-                    if chain_i not in contacts:
-                        contacts[chain_i] = []
-                    if chain_j not in contacts:
-                        contacts[chain_j] = []
+    # Load the contacts, note that here we are using it0 models
+    logging.info('Extracting contacts from the top %i models', len(top_models))
+    with profiler.stage('gather_contacts', len(top_models), hot=True):
+        contacts = gather_contacts(top_models, args.contact_cutoff)
+    with profiler.stage('residue_frequencies', len(top_models)):
+        frequencies = residue_frequencies(contacts, args.top, len(top_models))
 
-                    contacts[chain_i].append(resnum_i)
-                    contacts[chain_j].append(resnum_j)
-    
     logging.info('Result of the contact analysis')
-    for chain in contacts:
-        contact_str = ','.join(map(str, set(contacts[chain])))
-        logging.info('Chain %s - %s', chain, contact_str)
+    for top in sorted(frequencies):
+        for chain in frequencies[top]:
+            contact_str = ','.join(map(str, frequencies[top][chain][0].tolist()))
+            logging.info('Top %i Chain %s - %s', top, chain, contact_str)
+
+    logging.info('Writing per-residue contact frequencies to %s', args.output)
+    with profiler.stage('write_frequencies', len(top_models)):
+        write_frequencies(frequencies, args.output)
+
+    if args.profile:
+        logging.info('Writing the profile to %s', args.profile)
+        profiler.write(args.profile)
 
     # done
@@ -0,0 +1,116 @@
+# Content-addressed cache of calculated contacts that can be shared between runs
+import hashlib
+import logging
+import os
+import tempfile
+import numpy as np
+
+from run_archive import default_file_mode, open_run_file
+
+# bump whenever the contact engine output changes, invalidates every cached entry
+ENGINE_VERSION = '2'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'capri51-contacts')
+
+
+def cache_key(pdb_f, radius):
+    """ Key of a contact calculation, a hash of the PDB contents, the search radius and the engine version
+
+    :param pdb_f: PDB filename
+    :param radius: Distance in Angstrom up to which the residue pairs are calculated
+    :type pdb_f: string
+    :type radius: float
+    :return: Hexadecimal key
+    :rtype: string
+    """
+    sha = hashlib.sha256(f'{ENGINE_VERSION}:{float(radius)!r}:'.encode('utf-8'))
+    with open_run_file(pdb_f, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f'{key}.npy')
+
+
+def cache_get(cache_dir, key):
+    """ Read an entry from the cache, a hit refreshes its position in the LRU order
+
+    :param cache_dir: Cache directory
+    :param key: Key as returned by cache_key
+    :type cache_dir: string
+    :type key: string
+    :return: The cached contacts or None
+    :rtype: numpy.ndarray
+    """
+    entry_f = _entry_path(cache_dir, key)
+    try:
+        contacts = np.load(entry_f)
+        os.utime(entry_f)
+    except (OSError, ValueError):
+        # missing, evicted in the meantime or unreadable, all mean a miss
+        return None
+    return contacts
+
+
+def cache_put(cache_dir, key, contacts):
+    """ Atomically add an entry to the cache
+
+    :param cache_dir: Cache directory
+    :param key: Key as returned by cache_key
+    :param contacts: Contacts to be cached
+    :type cache_dir: string
+    :type key: string
+    :type contacts: numpy.ndarray
+    """
+    entry_f = _entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(entry_f), exist_ok=True)
+    fd, tmp_f = tempfile.mkstemp(dir=os.path.dirname(entry_f), prefix='.tmp-', suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as out_fh:
+            np.save(out_fh, contacts)
+        # the cache is shared, its entries are readable like any other file
+        os.chmod(tmp_f, default_file_mode())
+        os.replace(tmp_f, entry_f)
+    except BaseException:
+        if os.path.isfile(tmp_f):
+            os.remove(tmp_f)
+        raise
+
+
+def evict_cache(cache_dir, max_size):
+    """ Remove the least recently used entries until the cache fits in a given size
+
+    :param cache_dir: Cache directory
+    :param max_size: Maximum size of the cache in bytes
+    :type cache_dir: string
+    :type max_size: int
+    :return: Number of entries removed
+    :rtype: int
+    """
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if not name.endswith('.npy') or name.startswith('.tmp-'):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry_f in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(entry_f)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+
+    if removed:
+        logging.info('Evicted %i entries from the contact cache %s', removed, cache_dir)
+    return removed
@@ -0,0 +1,330 @@
+# In-process replacement for haddock-tools' contact-chainID and a compact store for its results
+import itertools
+import json
+import os
+import struct
+import tempfile
+import numpy as np
+
+from run_archive import default_file_mode, open_run_file, resolve_path, run_file_exists
+
+ATOM_DTYPE = np.dtype([('chain', 'U1'), ('resnum', 'i4'), ('name', 'U4'), ('resid', 'i4')])
+
+# one row per residue pair within the calculation radius, chains are stored as their character code and the
+#  distance is the minimum heavy-atom distance between the two residues
+CONTACT_DTYPE = np.dtype([('chain_i', '<i4'), ('resnum_i', '<i4'), ('chain_j', '<i4'), ('resnum_j', '<i4'),
+                          ('distance', '<f4')])
+STORE_DTYPE = np.dtype([('model', '<i4')] + CONTACT_DTYPE.descr)
+# residue pairs are calculated up to this distance, any contact cutoff below it is a threshold on the distances
+DEFAULT_RADIUS = 6.
+# contact-chainID, and so the legacy .contacts files, only has the contacts within this distance
+LEGACY_RADIUS = 4.9
+STORE_NAME = 'contacts.store'
+STORE_MAGIC = b'CONTSTR2'
+STORE_ALIGN = 64
+
+
+def read_atoms(pdb_f):
+    """ Read the heavy atoms of a PDB file into NumPy arrays
+
+    :param pdb_f: PDB filename
+    :type pdb_f: string
+    :return: Atom annotations (chain, resnum, name, resid) and a (n, 3) coordinate array,
+        resid is a sequential residue index that changes whenever chain or resnum changes
+    :rtype: tuple
+    """
+    records = []
+    coords = []
+    resid = -1
+    previous = None
+    with open_run_file(pdb_f) as fh:
+        for line in fh:
+            if not line.startswith('ATOM'):
+                continue
+            name = line[12:16].strip()
+            if name.startswith('H'):
+                # only heavy atoms are considered
+                continue
+            chain = line[21]
+            resnum = int(line[22:26])
+            if (chain, resnum) != previous:
+                resid += 1
+                previous = chain, resnum
+            records.append((chain, resnum, name, resid))
+            coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+
+    atoms = np.array(records, dtype=ATOM_DTYPE)
+    coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+    return atoms, coords
+
+
+def _neighbour_pairs(coords, groups, cutoff):
+    """ Find all the atom index pairs (i < j) of different groups closer than a cutoff with a cell list
+
+    :param coords: (n, 3) coordinate array
+    :param groups: (n,) integer array, pairs within the same group are skipped
+    :param cutoff: Distance cutoff in Angstrom
+    :type coords: numpy.ndarray
+    :type groups: numpy.ndarray
+    :type cutoff: float
+    :return: Arrays i, j and the distance between them
+    :rtype: tuple
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if len(coords) < 2:
+        return empty, empty, np.empty(0)
+
+    # pad the grid by one cell on each side so neighbour offsets never wrap around
+    cells = np.floor((coords - coords.min(axis=0)) / cutoff).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    cell_id = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(cell_id, kind='stable')
+    sorted_id = cell_id[order]
+
+    cutoff_sq = cutoff * cutoff
+    pair_i, pair_j, pair_d = [], [], []
+    # only half of the neighbouring cells are needed, the other half is covered by symmetry
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        if offset < (0, 0, 0):
+            continue
+        dx, dy, dz = offset
+        target = cell_id + (dx * dims[1] + dy) * dims[2] + dz
+        start = np.searchsorted(sorted_id, target, side='left')
+        counts = np.searchsorted(sorted_id, target, side='right') - start
+        total = counts.sum()
+        if not total:
+            continue
+        i = np.repeat(np.arange(len(coords)), counts)
+        j = order[np.arange(total) - np.repeat(np.cumsum(counts) - counts - start, counts)]
+        keep = groups[i] != groups[j]
+        if offset == (0, 0, 0):
+            keep &= i < j
+        i, j = i[keep], j[keep]
+        d_sq = ((coords[i] - coords[j]) ** 2).sum(axis=1)
+        within = d_sq < cutoff_sq
+        i, j = i[within], j[within]
+        swap = i > j
+        pair_i.append(np.where(swap, j, i))
+        pair_j.append(np.where(swap, i, j))
+        pair_d.append(np.sqrt(d_sq[within]))
+
+    if not pair_i:
+        return empty, empty, np.empty(0)
+    return np.concatenate(pair_i), np.concatenate(pair_j), np.concatenate(pair_d)
+
+
+def atom_contacts(atoms, coords, cutoff=4.9):
+    """ Calculate all the intermolecular atom contacts, ordered as contact-chainID reports them
+
+    :param atoms: Atom annotations as returned by read_atoms
+    :param coords: Coordinates as returned by read_atoms
+    :param cutoff: Distance cutoff in Angstrom
+    :type atoms: numpy.ndarray
+    :type coords: numpy.ndarray
+    :type cutoff: float
+    :return: Atom indexes i, j and the distance between them
+    :rtype: tuple
+    """
+    _, chain_code = np.unique(atoms['chain'], return_inverse=True)
+    i, j, d = _neighbour_pairs(coords, chain_code, cutoff)
+    # residue pair first, then atom pair, both in file order
+    order = np.lexsort((j, i, atoms['resid'][j], atoms['resid'][i]))
+    return i[order], j[order], d[order]
+
+
+def residue_contacts(atoms, i, j, d):
+    """ Collapse atom contacts into the unique residue pairs and their minimum distance, in first-seen order
+
+    :param atoms: Atom annotations as returned by read_atoms
+    :param i: Atom indexes of the first partner
+    :param j: Atom indexes of the second partner
+    :param d: Distances between the partners
+    :type atoms: numpy.ndarray
+    :type i: numpy.ndarray
+    :type j: numpy.ndarray
+    :type d: numpy.ndarray
+    :return: Residue contacts (chain_i, resnum_i, chain_j, resnum_j, distance), chains as character codes
+    :rtype: numpy.ndarray
+    """
+    # atom contacts come sorted by residue pair, so the first-seen order is the sorted one
+    resid_pairs = np.stack([atoms['resid'][i], atoms['resid'][j]], axis=1)
+    _, first = np.unique(resid_pairs, axis=0, return_index=True)
+    first.sort()
+    contacts = np.empty(len(first), dtype=CONTACT_DTYPE)
+    contacts['distance'] = np.minimum.reduceat(d, first) if len(first) else []
+    i, j = i[first], j[first]
+    contacts['chain_i'] = [ord(c) for c in atoms['chain'][i].tolist()]
+    contacts['resnum_i'] = atoms['resnum'][i]
+    contacts['chain_j'] = [ord(c) for c in atoms['chain'][j].tolist()]
+    contacts['resnum_j'] = atoms['resnum'][j]
+    return contacts
+
+
+def within_cutoff(contacts, cutoff):
+    """ Keep the residue contacts closer than a cutoff
+
+    :param contacts: Residue contacts or store table, anything with a distance field
+    :param cutoff: Distance cutoff in Angstrom, None keeps everything
+    :type contacts: numpy.ndarray
+    :type cutoff: float
+    :return: The selected rows
+    :rtype: numpy.ndarray
+    """
+    if cutoff is None:
+        return contacts
+    return contacts[contacts['distance'] < cutoff]
+
+
+def format_contacts(atoms, i, j, d):
+    """ Format atom contacts exactly like the output of contact-chainID
+
+    :param atoms: Atom annotations as returned by read_atoms
+    :param i: Atom indexes of the first partner
+    :param j: Atom indexes of the second partner
+    :param d: Distances between the partners
+    :type atoms: numpy.ndarray
+    :type i: numpy.ndarray
+    :type j: numpy.ndarray
+    :type d: numpy.ndarray
+    :return: contact-chainID formatted output
+    :rtype: string
+    """
+    lines = zip(atoms['resnum'][i].tolist(), atoms['chain'][i].tolist(), atoms['name'][i].tolist(),
+                atoms['resnum'][j].tolist(), atoms['chain'][j].tolist(), atoms['name'][j].tolist(), d.tolist())
+    return ''.join(f'{res_i} {chain_i} {name_i} {res_j} {chain_j} {name_j} {dist:.3f}\n'
+                   for res_i, chain_i, name_i, res_j, chain_j, name_j, dist in lines)
+
+
+def parse_contact_file(contact_file):
+    """ Parse a contact-chainID output file into its unique residue contacts
+
+    :param contact_file: Legacy .contacts filename
+    :type contact_file: string
+    :return: Residue contacts with their minimum distance, None if the file is missing
+    :rtype: numpy.ndarray
+    """
+    if not run_file_exists(contact_file):
+        return None
+    with open_run_file(contact_file) as con_fh:
+        # a dict de-duplicates the pairs while keeping the order they were first seen and their minimum distance
+        contacts = {}
+        for data in map(str.split, con_fh):
+            pair = (ord(data[1]), int(data[0]), ord(data[4]), int(data[3]))
+            contacts[pair] = min(float(data[6]), contacts.get(pair, float('inf')))
+    return np.array([pair + (distance,) for pair, distance in contacts.items()], dtype=CONTACT_DTYPE)
+
+
+def build_table(model_contacts):
+    """ Concatenate the residue contacts of many models into a single store table
+
+    :param model_contacts: Iterable of (model_index, contacts) with contacts as returned by residue_contacts
+    :type model_contacts: iterable
+    :return: Store table sorted by model index
+    :rtype: numpy.ndarray
+    """
+    blocks = []
+    for model_idx, contacts in model_contacts:
+        block = np.empty(len(contacts), dtype=STORE_DTYPE)
+        block['model'] = model_idx
+        for field in CONTACT_DTYPE.names:
+            block[field] = contacts[field]
+        blocks.append(block)
+    if not blocks:
+        return np.empty(0, dtype=STORE_DTYPE)
+    table = np.concatenate(blocks)
+    return table[np.argsort(table['model'], kind='stable')]
+
+
+def _data_offset(header_size):
+    """ Position of the table inside a store file, aligned so it can be memory-mapped """
+    header_size += len(STORE_MAGIC) + 8
+    return -(-header_size // STORE_ALIGN) * STORE_ALIGN
+
+
+def write_store(store_f, names, table, radius=None):
+    """ Atomically write a contact store: a small header, the model names and the contact table
+
+    :param store_f: Store filename
+    :param names: Model names, the model column of the table indexes this list
+    :param table: Store table, as returned by build_table
+    :param radius: Distance up to which the residue pairs were calculated, None if unknown
+    :type store_f: string
+    :type names: list
+    :type table: numpy.ndarray
+    :type radius: float
+    """
+    header_b = json.dumps({'radius': radius, 'names': list(names)}).encode('utf-8')
+    header = STORE_MAGIC + struct.pack('<Q', len(header_b)) + header_b
+    header += b'\0' * (_data_offset(len(header_b)) - len(header))
+    # write next to the destination and rename, readers never see a partial store
+    fd, tmp_f = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(store_f)), prefix='.contacts-')
+    try:
+        with os.fdopen(fd, 'wb') as out_fh:
+            out_fh.write(header)
+            out_fh.write(np.ascontiguousarray(table, dtype=STORE_DTYPE).tobytes())
+            out_fh.flush()
+            os.fsync(out_fh.fileno())
+        # readable like the other files of the run, not only by its owner
+        os.chmod(tmp_f, default_file_mode())
+        os.replace(tmp_f, store_f)
+    except BaseException:
+        if os.path.isfile(tmp_f):
+            os.remove(tmp_f)
+        raise
+
+
+def _read_header(fh, store_f):
+    """ Read the header of a store, returns the model names, the radius and the offset of the table """
+    if fh.read(len(STORE_MAGIC)) != STORE_MAGIC:
+        raise ValueError(f'{store_f} is not a contact store')
+    header_size, = struct.unpack('<Q', fh.read(8))
+    header = json.loads(fh.read(header_size).decode('utf-8'))
+    return header['names'], header['radius'], _data_offset(header_size)
+
+
+def load_store(store_f, cutoff=None):
+    """ Load a contact store, the table is memory-mapped so nothing is copied until used
+
+    Stores that are gzipped or inside a run archive are read into memory instead. With a cutoff only the residue
+    pairs closer than it are returned, which is a copy.
+
+    :param store_f: Store filename
+    :param cutoff: Contact cutoff in Angstrom, it cannot be larger than the radius of the store, None for all pairs
+    :type store_f: string
+    :type cutoff: float
+    :return: Model names and the (read-only) store table
+    :rtype: tuple
+    """
+    filename = resolve_path(store_f)
+    if filename is None or filename.endswith('.gz'):
+        with open_run_file(store_f, 'rb') as fh:
+            names, radius, offset = _read_header(fh, store_f)
+            fh.seek(offset)
+            table = np.frombuffer(fh.read(), dtype=STORE_DTYPE)
+    else:
+        with open(filename, 'rb') as fh:
+            names, radius, offset = _read_header(fh, store_f)
+        if os.path.getsize(filename) == offset:
+            table = np.empty(0, dtype=STORE_DTYPE)
+        else:
+            table = np.memmap(filename, dtype=STORE_DTYPE, mode='r', offset=offset)
+
+    if cutoff is not None and radius is not None and cutoff > radius:
+        raise ValueError(f'{store_f} has the residue pairs up to {radius} A, it cannot answer a cutoff of {cutoff} A')
+    if cutoff is None or (radius is not None and cutoff == radius):
+        return names, table
+    return names, within_cutoff(table, cutoff)
+
+
+def split_models(names, table):
+    """ Split a store table into per-model views, {name: table rows}
+
+    :param names: Model names of the store
+    :param table: Store table sorted by model index
+    :type names: list
+    :type table: numpy.ndarray
+    :return: {model name: view of its rows}
+    :rtype: dict
+    """
+    bounds = np.searchsorted(table['model'], np.arange(len(names) + 1))
+    return {name: table[bounds[idx]:bounds[idx + 1]] for idx, name in enumerate(names)}
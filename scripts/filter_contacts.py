@@ -1,121 +1,330 @@
 # Quick script to filter-out unwanted contacts
 import logging
 import argparse
+import contextlib
 import multiprocessing
 import os
-import subprocess
-import itertools
-
-nsp7 = list(range(116, 196))
-exosc4 = list(range(304, 537))
-exosc2 = list(range(1747, 1996))
-forbidden_contacts = list(itertools.product(*[nsp7, exosc2])) + list(itertools.product(*[nsp7, exosc4]))
-
-
-def calculate_contact(contact_exe, pdb_file, cutoff=4.9):
-    """Calculate all intermolecular contacts present in a PDB file in a given cutoff."""
-    output_f = pdb_file.replace('.pdb', '.contacts')
-    if not os.path.isfile(output_f):
-        logging.debug('Calculating contacts in %s', pdb_file)
-        cmd = [contact_exe, pdb_file, f'{cutoff}']
-        result = subprocess.run(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                universal_newlines=True)
-        if not result.stdout:
-            return False
-        with open(output_f, 'w') as out_fh:
-            out_fh.write(result.stdout)
-    return output_f
-
-
-def load_contacts(rundir):
-    """Parse multiple contact files and load them into a dictionary {PDB: (contacts)}."""
-    logging.info('Reading contact files into internal data structure')
-    contacts = {}
-    with open(f'{rundir}/structures/it0/file.nam', 'r') as file_h:
-        for line in file_h.readlines():
-            pdb = line[:-1]
-            contacts[pdb] = []
-            contact_file = f"{rundir}/structures/it0/{pdb.replace('.pdb','.contacts')}"
-            if not os.path.isfile(contact_file):
-                logging.warning('No contact file for %s', pdb)
-            else:
-                with open(contact_file, 'r') as con_fh:
-                    for line in con_fh.readlines():
-                        data = line.split()
-                        resnum_i = int(data[0])
-                        resnum_j = int(data[3])
-                        pair = resnum_i, resnum_j
-                        if pair not in contacts[pdb]:
-                            contacts[pdb].append(pair)
+import json
+import functools
+import time
+import numpy as np
+
+from contact_analysis import residue_frequencies, write_frequencies
+from contact_cache import DEFAULT_CACHE_DIR, cache_key, cache_get, cache_put, evict_cache
+from haddock_files import read_file_nam
+from run_watcher import ModelWatcher
+from run_archive import map_run_files, writable_path
+from profiling import Profiler, TimedWorker, worker_pool
+from contacts import (DEFAULT_RADIUS, STORE_NAME, read_atoms, atom_contacts, residue_contacts, within_cutoff,
+                      parse_contact_file, build_table, write_store)
+
+# nsp7 x EXOSC2 and nsp7 x EXOSC4
+DEFAULT_FORBIDDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forbidden_contacts.json')
+# in watch mode, the running contact frequencies are rewritten at most this often
+FREQUENCIES_INTERVAL_S = 30
+
+
+def load_forbidden(config_f):
+    """Load the forbidden regions {name: {"i": [start, end], "j": [start, end]}} as rows of inclusive residue ranges."""
+    with open(config_f) as fh:
+        regions = json.load(fh)
+    forbidden = np.array([regions[name]['i'] + regions[name]['j'] for name in regions], dtype=np.int64)
+    return forbidden.reshape(-1, 4)
+
+
+def calculate_contact(pdb_file, radius=DEFAULT_RADIUS, cache_dir=None):
+    """Calculate the intermolecular residue pairs of a PDB within a radius and their distance, reusing the cache."""
+    key = cache_key(pdb_file, radius) if cache_dir else None
+    contacts = cache_get(cache_dir, key) if key else None
+    if contacts is None:
+        atoms, coords = read_atoms(pdb_file)
+        i, j, d = atom_contacts(atoms, coords, radius)
+        contacts = residue_contacts(atoms, i, j, d)
+        if key:
+            cache_put(cache_dir, key, contacts)
+    if not len(contacts):
+        return False
     return contacts
 
 
-def filter_contacts(contact_d, forbidden_contacts, cutoff):
-    """Filter the contacts by checking if any of the observed are present in the forbidden list."""
-    logging.info('Filtering contacts, total forbidden contacts=%i forbidden contacts cutoff=%.2f', len(forbidden_contacts), cutoff)
-    allowed_pdbs = []
-    for pdb in contact_d:
-        pdb_contacts = contact_d[pdb]
-        if not pdb_contacts:
+def contact_worker(pdb_file, radius=DEFAULT_RADIUS, cache_dir=None):
+    """Pool worker around calculate_contact, returns (pdb_file, contacts, error) so failures reach the parent."""
+    try:
+        return pdb_file, calculate_contact(pdb_file, radius, cache_dir), None
+    except Exception as err:
+        return pdb_file, False, f'{type(err).__name__}: {err}'
+
+
+def iter_contacts(pdb_files, nproc=1, radius=DEFAULT_RADIUS, cache_dir=None, cprofile_f=None, pool=None):
+    """Calculate the contacts of many PDBs in a pool, yields ((pdb_file, contacts, error), timing) in input order.
+
+    Results are yielded as soon as all the PDBs before them are done, so outputs written on the fly keep the order
+    of the input and are the same from one run to the next. A pool given by the caller is used and left open,
+    otherwise one is created for the call.
+    """
+    worker = TimedWorker(functools.partial(contact_worker, radius=radius, cache_dir=cache_dir))
+    chunksize = max(1, min(16, len(pdb_files) // (nproc * 4)))
+    # models of a run archive are read here, in a single pass, and handed to the workers
+    if pool is not None:
+        yield from map_run_files(worker, pdb_files, functools.partial(pool.imap, chunksize=chunksize))
+        return
+    with worker_pool(nproc, cprofile_f) as pool:  # no logging inside the pool, timings are sent back
+        yield from map_run_files(worker, pdb_files, functools.partial(pool.imap, chunksize=chunksize))
+
+
+def watch_contacts(watcher, nproc=1, radius=DEFAULT_RADIUS, cache_dir=None, cprofile_f=None, poll_s=10.,
+                   idle_timeout=3600.):
+    """Calculate the contacts of the models of a stage as HADDOCK writes them, yields like iter_contacts until it is over.
+
+    A single pool processes every batch of new models, for the whole duration of the watch.
+    """
+    last_model = time.time()
+    with worker_pool(nproc, cprofile_f) as pool:
+        while not watcher.finished():
+            ready = watcher.poll()
+            if ready:
+                logging.info('%i new models, %i so far', len(ready), len(watcher.handed_out))
+                yield from iter_contacts([f'{watcher.model_dir}/{pdb}' for pdb in ready], nproc, radius, cache_dir,
+                                         cprofile_f, pool)
+                last_model = time.time()
+            elif time.time() - last_model > idle_timeout:
+                logging.warning('No new model in %s for %i seconds, giving up', watcher.model_dir, idle_timeout)
+                return
+            else:
+                time.sleep(poll_s)
+
+
+def write_running_frequencies(tables, output_f):
+    """Write how many of the models filtered so far each residue is in contact with, replacing the previous table."""
+    frequencies = residue_frequencies(np.concatenate([build_table([])] + tables), [len(tables)], len(tables))
+    tmp_f = f'{output_f}.tmp'
+    write_frequencies(frequencies, tmp_f)
+    os.replace(tmp_f, output_f)
+
+
+def load_contact_files(rundir, nproc=1):
+    """Parse the legacy .contacts files of the models in file.nam as (PDB names, contact table)."""
+    names = read_file_nam(f'{rundir}/structures/it0/file.nam')
+    contact_files = [f"{rundir}/structures/it0/{pdb.replace('.pdb', '.contacts')}" for pdb in names]
+
+    with multiprocessing.Pool(processes=nproc) as pool:
+        imap = functools.partial(pool.imap, chunksize=max(1, len(contact_files) // (nproc * 4)))
+        parsed = list(map_run_files(parse_contact_file, contact_files, imap))
+
+    model_contacts = []
+    for model_idx, (pdb, contacts) in enumerate(zip(names, parsed)):
+        if contacts is None:
+            logging.warning('No contact file for %s', pdb)
             continue
-        total_pdb_contacts = len(pdb_contacts)
-        intersection = len(set(pdb_contacts).intersection(forbidden_contacts))
+        model_contacts.append((model_idx, contacts))
+    return names, build_table(model_contacts)
 
-        per_forbidden = intersection / total_pdb_contacts
 
-        if per_forbidden <= cutoff:
-            allowed_pdbs.append(pdb)
-        else:
-            logging.info('Structure %s discarded (%.2f)', pdb, per_forbidden)
-    
-    return allowed_pdbs
+def forbidden_fraction(n_models, table, forbidden):
+    """Calculate the fraction of forbidden contacts of every model of a contact table at once."""
+    # unique residue pairs per model, packed into a single integer key, residue numbers can be negative so they are
+    #  packed relative to the smallest one
+    resnum_i = table['resnum_i'].astype(np.int64)
+    resnum_j = table['resnum_j'].astype(np.int64)
+    offset = min(resnum_i.min(), resnum_j.min()) if len(table) else 0
+    key = np.sort((table['model'].astype(np.int64) << 42) | ((resnum_i - offset) << 21) | (resnum_j - offset))
+    key = key[np.concatenate([key[:1] == key[:1], key[1:] != key[:-1]])]
+    model = key >> 42
+    resnum_i = ((key >> 21) & 0x1FFFFF) + offset
+    resnum_j = (key & 0x1FFFFF) + offset
+
+    is_forbidden = np.zeros(len(key), dtype=bool)
+    for i_start, i_end, j_start, j_end in forbidden:
+        is_forbidden |= (resnum_i >= i_start) & (resnum_i <= i_end) & (resnum_j >= j_start) & (resnum_j <= j_end)
+
+    total = np.bincount(model, minlength=n_models)
+    forbidden_total = np.bincount(model, weights=is_forbidden, minlength=n_models)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total, forbidden_total / total
+
+
+def is_allowed(pdb, total, per_forbidden, cutoff):
+    """Decide if a model passes the filter, models without contacts never do."""
+    if not total:
+        return False
+    if per_forbidden <= cutoff:
+        return True
+    logging.info('Structure %s discarded (%.2f)', pdb, per_forbidden)
+    return False
+
+
+def sweep_list(cutoff):
+    """Name of the filtered list of a cutoff when several cutoffs are swept, e.g. filtered-pdbs-0.20.list."""
+    return f'filtered-pdbs-{cutoff:.2f}.list'
+
+
+def write_sweep_summary(passed, n_models, output_f):
+    """Write how many models pass the filter at every cutoff of a sweep as a tab separated file."""
+    with open(output_f, 'w') as out_fh:
+        out_fh.write('cutoff\tpassed\tmodels\tfraction\tfiltered_list\n')
+        for cutoff in sorted(passed):
+            fraction = passed[cutoff] / n_models if n_models else 0.
+            out_fh.write(f'{cutoff:.2f}\t{passed[cutoff]}\t{n_models}\t{fraction:.3f}\t{sweep_list(cutoff)}\n')
+
+
+def without_contacts(names, table):
+    """Names of the models without any contact in a contact table, they are failed models rather than discarded ones."""
+    counts = np.bincount(table['model'], minlength=len(names))
+    return [pdb for pdb, count in zip(names, counts.tolist()) if not count]
+
+
+def filter_contacts(names, table, forbidden, cutoff):
+    """Filter the contacts by checking how many of the observed are inside the forbidden regions."""
+    logging.info('Filtering contacts, total forbidden regions=%i forbidden contacts cutoff=%.2f', len(forbidden), cutoff)
+    total, per_forbidden = forbidden_fraction(len(names), table, forbidden)
+    return [pdb for pdb, pdb_total, pdb_forbidden in zip(names, total.tolist(), per_forbidden.tolist())
+            if is_allowed(pdb, pdb_total, pdb_forbidden, cutoff)]
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("run_directory", help='file.nam generated by HADDOCK')
-    parser.add_argument("contact_exec", help='Compiled contact script')
     parser.add_argument("--np", help='Number of processors to use', type=int, default=2)
-    parser.add_argument("--cutoff", help='Cutoff of forbidden contacts allowed in the PDB to be filtered, float between 0 and 1', type=float, default=.2)
+    parser.add_argument("--cutoff", help='Cutoff of forbidden contacts allowed in the PDB to be filtered, float between 0 and 1, several values can be given to compare them', type=float, nargs='+', default=[.2])
+    parser.add_argument("--fractions", help='With several cutoffs, the forbidden fraction of every model is written to this file, default=forbidden-fractions.tsv', default='forbidden-fractions.tsv')
+    parser.add_argument("--summary", help='With several cutoffs, the number of models passing each cutoff is written to this file, default=cutoff-summary.tsv', default='cutoff-summary.tsv')
+    parser.add_argument("--forbidden", help='JSON file with the forbidden regions as residue ranges', default=DEFAULT_FORBIDDEN)
+    parser.add_argument("--contact_cutoff", help='Distance cutoff in Angstrom used to define a contact', type=float, default=4.9)
+    parser.add_argument("--radius", help=f'Residue pairs are stored up to this distance in Angstrom, so any smaller contact cutoff can be used later without recalculating, default={DEFAULT_RADIUS}', type=float, default=DEFAULT_RADIUS)
+    parser.add_argument("--cache_dir", help=f'Contact cache shared between runs, default={DEFAULT_CACHE_DIR}', default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--cache_size", help='Maximum size of the contact cache in MB, default=1024', type=int, default=1024)
+    parser.add_argument("--watch", help='Process the models of it0 as HADDOCK writes them, until file.nam lists no model left', action='store_true')
+    parser.add_argument("--frequencies", help='With --watch, the contact frequencies of the residues over the filtered models are kept up to date in this file, default=running-frequencies.tsv', default='running-frequencies.tsv')
+    parser.add_argument("--poll", help='With --watch, seconds between two looks at the it0 directory, default=10', type=float, default=10.)
+    parser.add_argument("--settle", help='With --watch, seconds a model without END record must stay unchanged to be processed, default=30', type=float, default=30.)
+    parser.add_argument("--idle_timeout", help='With --watch, give up after this many seconds without new models, default=3600', type=float, default=3600.)
+    parser.add_argument("--profile", help='Write the time, memory and throughput of every stage to this JSON file')
+    parser.add_argument("--cprofile", help='With --profile, dump the cProfile statistics of the contact calculation to this file')
     args = parser.parse_args()
 
     logging.basicConfig(level='DEBUG',
                         format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
                         datefmt='%d/%m/%Y %H:%M:%S')
 
+    profiler = Profiler('filter_contacts', args.cprofile if args.profile else None)
+
     # Load the PDBs, note that here we are using it0 models
-    logging.info('Loading PDB list from run directory %s', args.run_directory)
-    pdb_list = []
-    with open(f'{args.run_directory}/structures/it0/file.nam', 'r') as fh:
-        for line in fh.readlines():
-            pdb_list.append(line)
+    #  in watch mode the models are picked up as they are written and file.nam only tells when it0 is over
+    it0 = f'{args.run_directory}/structures/it0'
+    pdb_list = None
+    if args.watch:
+        logging.info('Watching %s for new models', it0)
+    else:
+        logging.info('Loading PDB list from run directory %s', args.run_directory)
+        with profiler.stage('read_file_nam') as stage:
+            pdb_list = read_file_nam(f'{it0}/file.nam')
+            stage['items'] = len(pdb_list)
 
-    # Use the contact script from haddock-tools to calculate contacts
+    # Calculate the contacts in-process (same definition as contact-chainID from haddock-tools)
     #  this is implemented using multiprocessors since this task can take a long time
     #  if there are too many PDBs, also because its embarassingly parallel so we might as well!
-    # If a contact file is already present, the function will not re-calculate it so no time is
-    #  wasted if you need to re-run this
-    logging.info('Calculating contacts for %i PDBs using %i processors', len(pdb_list), args.np)
-    pool = multiprocessing.Pool(processes=args.np)  # no logging inside the pool because its way to complicated
-    for pdb in pdb_list:
-        pdb_name = pdb[:-1]  # remove \n
-        full_pdbname = f'{args.run_directory}/structures/it0/{pdb_name}'
-        pool.apply_async(calculate_contact, args=(args.contact_exec, full_pdbname,))
-    pool.close()
-    pool.join()
-
-    # Load the contacts in a dictionary
-    observed_contacts = load_contacts(args.run_directory)
-
-    # Finally do the filtering
-    filtered_pdbs = filter_contacts(observed_contacts, forbidden_contacts, args.cutoff)
-    
-    # output to a text file
-    logging.info('Writing filtered pdbs to filtered-pdbs.list')
-    with open('filtered-pdbs.list', 'w') as out_fh:
-        for pdb in filtered_pdbs:
-            out_fh.write(f'{args.run_directory}/structures/it0/{pdb}\n')
-    out_fh.close()
+    # Results are cached by the contents of the PDB and the search radius, so no time is wasted
+    #  if you need to re-run this, also from another run directory
+    # The residue pairs are calculated up to a radius larger than the contact cutoff and kept in the store with their
+    #  distance, later analyses can then use any contact cutoff up to the radius
+    store_f = f'{it0}/{STORE_NAME}'
+    radius = max(args.radius, args.contact_cutoff)
+    forbidden_contacts = load_forbidden(args.forbidden)
+
+    # The filter is applied as soon as the contacts of a model are ready and the output is written progressively
+    #  with several cutoffs the forbidden fraction of a model is calculated once and compared to each of them,
+    #  every cutoff gets its own filtered list
+    cutoffs = sorted(set(args.cutoff))
+    sweep = len(cutoffs) > 1
+    list_fs = {cutoff: sweep_list(cutoff) if sweep else 'filtered-pdbs.list' for cutoff in cutoffs}
+    logging.info('Writing filtered pdbs to %s', ', '.join(list_fs.values()))
+    logging.info('Filtering contacts, total forbidden regions=%i forbidden contacts cutoff=%s',
+                 len(forbidden_contacts), ', '.join(f'{cutoff:.2f}' for cutoff in cutoffs))
+    passed = dict.fromkeys(cutoffs, 0)
+    # in watch mode, the contacts of the models passing the strictest cutoff, for the running frequencies
+    frequency_tables = []
+    last_frequencies = time.time()
+    with contextlib.ExitStack() as stack, profiler.stage('contacts', pdb_list and len(pdb_list), hot=True) as stage:
+        out_fhs = {cutoff: stack.enter_context(open(list_f, 'w')) for cutoff, list_f in list_fs.items()}
+        if sweep:
+            fractions_fh = stack.enter_context(open(args.fractions, 'w'))
+            fractions_fh.write('pdb\tcontacts\tforbidden\tfraction\n')
+        names = []
+        tables = []
+        failed_pdbs = []
+        n_models = 0
+        if args.watch:
+            logging.info('Calculating contacts of the new models using %i processors', args.np)
+            results = watch_contacts(ModelWatcher(it0, args.settle), args.np, radius, args.cache_dir,
+                                     profiler.cprofile_f, args.poll, args.idle_timeout)
+        else:
+            logging.info('Calculating contacts for %i PDBs using %i processors', len(pdb_list), args.np)
+            pdb_files = [f'{it0}/{pdb}' for pdb in pdb_list]
+            results = iter_contacts(pdb_files, args.np, radius, args.cache_dir, profiler.cprofile_f)
+        for (pdb_file, pairs, error), timing in results:
+            profiler.worker_done(timing)
+            n_models += 1
+            pdb = os.path.basename(pdb_file)
+            if pairs is False:
+                logging.warning('Could not calculate contacts for %s: %s', pdb, error or 'no contacts found')
+                failed_pdbs.append(pdb_file)
+                continue
+
+            tables.append(build_table([(len(names), pairs)]))
+            names.append(pdb)
+            contacts = build_table([(0, within_cutoff(pairs, args.contact_cutoff))])
+            if not len(contacts):
+                # residue pairs within the radius only: kept in the store, but the model failed like it has no
+                #  contacts at all, as in sharded_filter.py
+                logging.warning('Could not calculate contacts for %s: no contacts found', pdb)
+                failed_pdbs.append(pdb_file)
+                continue
+            total, per_forbidden = forbidden_fraction(1, contacts, forbidden_contacts)
+            if sweep:
+                n_forbidden = round(total[0] * per_forbidden[0])
+                fractions_fh.write(f'{pdb_file}\t{total[0]}\t{n_forbidden}\t{per_forbidden[0]:.4f}\n')
+            # discarded models are those above the loosest cutoff, the others pass every cutoff from their fraction up
+            if not is_allowed(pdb, total[0], per_forbidden[0], cutoffs[-1]):
+                continue
+            for cutoff in cutoffs:
+                if per_forbidden[0] <= cutoff:
+                    passed[cutoff] += 1
+                    out_fhs[cutoff].write(f'{pdb_file}\n')
+                    out_fhs[cutoff].flush()
+            if args.watch and per_forbidden[0] <= cutoffs[0]:
+                contacts['model'] = len(frequency_tables)
+                frequency_tables.append(contacts)
+                if time.time() - last_frequencies >= FREQUENCIES_INTERVAL_S:
+                    write_running_frequencies(frequency_tables, args.frequencies)
+                    last_frequencies = time.time()
+        stage['items'] = n_models
+
+    if args.watch:
+        logging.info('Writing the contact frequencies over %i filtered models to %s', len(frequency_tables),
+                     args.frequencies)
+        write_running_frequencies(frequency_tables, args.frequencies)
+
+    logging.info('Writing the contacts of %i models to the contact store %s', len(names), store_f)
+    with profiler.stage('write_store', len(names)):
+        write_store(writable_path(store_f), names, np.concatenate([build_table([])] + tables), radius)
+    with profiler.stage('evict_cache'):
+        evict_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    if sweep:
+        n_filtered = n_models - len(failed_pdbs)
+        for cutoff in cutoffs:
+            logging.info('Cutoff %.2f: %i of %i models passed the filter', cutoff, passed[cutoff], n_filtered)
+        logging.info('Writing the forbidden fractions to %s and the summary to %s', args.fractions, args.summary)
+        write_sweep_summary(passed, n_filtered, args.summary)
+
+    if failed_pdbs:
+        logging.warning('%i models failed, see failed-pdbs.list', len(failed_pdbs))
+        with open('failed-pdbs.list', 'w') as fail_fh:
+            for pdb_file in failed_pdbs:
+                fail_fh.write(f'{pdb_file}\n')
+
+    if args.profile:
+        logging.info('Writing the profile to %s', args.profile)
+        profiler.write(args.profile)
 
     # done
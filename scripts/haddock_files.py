@@ -0,0 +1,32 @@
+# Parsers of the HADDOCK run files shared by the scripts
+from run_archive import open_run_file
+
+
+def read_file_nam(file_nam):
+    """ Read the model names of a HADDOCK file.nam, in order
+
+    :param file_nam: file.nam filename
+    :type file_nam: string
+    :return: PDB names
+    :rtype: list
+    """
+    with open_run_file(file_nam) as fh:
+        return [line.rstrip('\n') for line in fh]
+
+
+def read_file_list(file_list):
+    """ Read the models of a HADDOCK file.list with their haddock-score, in the order of the file (best first)
+
+    Lines look like: "PREVIT:complex_1.pdb"  { -45.1 }
+
+    :param file_list: file.list filename
+    :type file_list: string
+    :return: (PDB name, haddock-score) of every model
+    :rtype: list
+    """
+    models = []
+    with open_run_file(file_list) as fh:
+        for line in fh:
+            fields = line.split()
+            models.append((fields[0].split(':')[-1][:-1], float(fields[-2])))
+    return models
@@ -0,0 +1,204 @@
+# Interface RMSD between the models of a run, used to keep near-duplicate models out of the submission
+#
+# The Calpha atoms of the interface residues of every model are loaded once into a single array, the RMSDs after
+#  optimal superposition (Kabsch) are then calculated for whole batches of model pairs with a few matrix operations.
+import functools
+import logging
+import multiprocessing
+import numpy as np
+
+from run_archive import map_run_files, open_run_file
+
+# CAPRI's interface: residues within 10A of another chain
+INTERFACE_CUTOFF = 10.
+
+
+def read_ca(pdb_f):
+    """ Read the Calpha atoms of a model
+
+    :param pdb_f: PDB filename
+    :type pdb_f: string
+    :return: Residue keys (chain, residue number and insertion code) and the coordinates of their Calpha atom
+    :rtype: tuple
+    """
+    ca_dic = {}
+    with open_run_file(pdb_f) as fh:
+        for line in fh:
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA':
+                # the first alternate location of a residue is kept
+                ca_dic.setdefault(line[21:27], (float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return list(ca_dic), np.array(list(ca_dic.values()), dtype=np.float64).reshape(-1, 3)
+
+
+def interface_mask(chains, xyz, cutoff=INTERFACE_CUTOFF, block_size=1024):
+    """ Which residues have their Calpha within cutoff of the Calpha of a residue of another chain
+
+    :param chains: Chain of every residue
+    :param xyz: (residues, 3) Calpha coordinates
+    :param cutoff: Distance cutoff in Angstrom
+    :param block_size: Number of residues whose distances are calculated at once
+    :type chains: numpy.ndarray
+    :type xyz: numpy.ndarray
+    :type cutoff: float
+    :type block_size: int
+    :rtype: numpy.ndarray
+    """
+    mask = np.zeros(len(xyz), dtype=bool)
+    sq_norms = (xyz ** 2).sum(1)
+    for start in range(0, len(xyz), block_size):
+        block = slice(start, start + block_size)
+        sq_dist = sq_norms[block, None] + sq_norms[None, :] - 2 * xyz[block] @ xyz.T
+        mask[block] = ((sq_dist <= cutoff ** 2) & (chains[block, None] != chains[None, :])).any(1)
+    return mask
+
+
+def load_interface_ca(pdb_files, reference_files, cutoff=INTERFACE_CUTOFF, nproc=1):
+    """ Load the interface Calpha coordinates of every model into a single array
+
+    The interface is the union of the interfaces of the reference models, only the residues present in every model
+    are used.
+
+    :param pdb_files: PDB filenames
+    :param reference_files: PDB filenames, among pdb_files, defining the interface
+    :param cutoff: Interface distance cutoff in Angstrom
+    :param nproc: Number of processors used to read the models
+    :type pdb_files: list
+    :type reference_files: list
+    :type cutoff: float
+    :type nproc: int
+    :return: Interface residue keys and the (models, residues, 3) coordinates
+    :rtype: tuple
+    """
+    if nproc > 1:
+        chunksize = max(1, len(pdb_files) // (nproc * 4))
+        with multiprocessing.Pool(processes=nproc) as pool:
+            models = list(map_run_files(read_ca, pdb_files, functools.partial(pool.imap, chunksize=chunksize)))
+    else:
+        models = list(map_run_files(read_ca, pdb_files))
+
+    # models of a run share their topology, this is only a safety net
+    common = set(models[0][0]).intersection(*(keys for keys, _ in models[1:]))
+    keys = [key for key in models[0][0] if key in common]
+    if len(keys) < len(models[0][0]):
+        logging.warning(f'{len(models[0][0]) - len(keys)} residues are not in every model, they are ignored')
+
+    coords = np.empty((len(models), len(keys), 3))
+    for idx, (model_keys, xyz) in enumerate(models):
+        if model_keys == keys:
+            coords[idx] = xyz
+        else:
+            positions = dict(zip(model_keys, range(len(model_keys))))
+            coords[idx] = xyz[[positions[key] for key in keys]]
+
+    file_idx = dict(zip(pdb_files, range(len(pdb_files))))
+    chains = np.array([key[0] for key in keys])
+    interface = np.zeros(len(keys), dtype=bool)
+    for reference_f in reference_files:
+        interface |= interface_mask(chains, coords[file_idx[reference_f]], cutoff)
+    return [key for key, kept in zip(keys, interface.tolist()) if kept], coords[:, interface]
+
+
+def kabsch_rmsd(centered, sq_norms, rows, cols):
+    """ RMSD after optimal superposition of every model of rows on every model of cols
+
+    With H the covariance of two centered coordinate sets, the minimal squared deviation is
+    |a|^2 + |b|^2 - 2 * (s1 + s2 + d * s3), s being the singular values of H and d the sign of its determinant,
+    so no rotation is ever built nor applied.
+
+    :param centered: (models, residues, 3) coordinates centered on their centroid
+    :param sq_norms: Sum of the squared centered coordinates of every model
+    :param rows: Model indexes
+    :param cols: Model indexes
+    :type centered: numpy.ndarray
+    :type sq_norms: numpy.ndarray
+    :type rows: numpy.ndarray
+    :type cols: numpy.ndarray
+    :return: (rows, cols) RMSD matrix
+    :rtype: numpy.ndarray
+    """
+    n_rows, n_cols, n_residues = len(rows), len(cols), centered.shape[1]
+    # all the 3x3 covariance matrices as a single matrix product
+    row_coords = centered[rows].transpose(0, 2, 1).reshape(n_rows * 3, n_residues)
+    col_coords = centered[cols].transpose(1, 0, 2).reshape(n_residues, n_cols * 3)
+    covariance = (row_coords @ col_coords).reshape(n_rows, 3, n_cols, 3).transpose(0, 2, 1, 3)
+    singular = np.linalg.svd(covariance, compute_uv=False)
+    singular[..., -1] *= np.sign(np.linalg.det(covariance))
+    sq_dev = sq_norms[rows, None] + sq_norms[None, cols] - 2 * singular.sum(-1)
+    return np.sqrt(np.maximum(sq_dev, 0) / max(n_residues, 1))
+
+
+def diverse_selection(coords, selection, candidates, n_models, cutoff, batch_size=256):
+    """ Add the candidates, in order, that are more than cutoff i-RMSD away from every model selected before them
+
+    The candidates are compared by batches, first to the models already selected and then to each other.
+
+    :param coords: (models, residues, 3) interface Calpha coordinates
+    :param selection: Indexes of the models already selected
+    :param candidates: Indexes of the candidate models, best first
+    :param n_models: Size of the selection
+    :param cutoff: i-RMSD in Angstrom under which a candidate is redundant
+    :param batch_size: Number of candidates compared at once
+    :type coords: numpy.ndarray
+    :type selection: list
+    :type candidates: list
+    :type n_models: int
+    :type cutoff: float
+    :type batch_size: int
+    :return: Indexes of the selected models
+    :rtype: list
+    """
+    centered = coords - coords.mean(1, keepdims=True)
+    sq_norms = (centered ** 2).sum((1, 2))
+    selection = list(selection)
+    candidates = np.asarray(candidates, dtype=np.int64)
+    for start in range(0, len(candidates), batch_size):
+        if len(selection) >= n_models:
+            break
+        batch = candidates[start:start + batch_size]
+        if selection:
+            batch = batch[(kabsch_rmsd(centered, sq_norms, batch, np.array(selection)) > cutoff).all(1)]
+        close = kabsch_rmsd(centered, sq_norms, batch, batch) <= cutoff
+        accepted = []
+        for idx in range(len(batch)):
+            if len(selection) + len(accepted) >= n_models:
+                break
+            if not close[idx, accepted].any():
+                accepted.append(idx)
+        selection += batch[accepted].tolist()
+    return selection
+
+
+def remove_redundant(selection, candidates, n_models, model_dir, cutoff, interface_cutoff=INTERFACE_CUTOFF,
+                     nproc=1):
+    """ Fill a selection with the candidates that are not within cutoff i-RMSD of a model already selected
+
+    The interface is defined by the models already selected, or by the first candidate if there are none.
+
+    :param selection: PDB names already selected
+    :param candidates: PDB names to fill the selection with, best first
+    :param n_models: Size of the selection
+    :param model_dir: Directory of the models
+    :param cutoff: i-RMSD in Angstrom under which a candidate is redundant
+    :param interface_cutoff: Interface distance cutoff in Angstrom
+    :param nproc: Number of processors used to read the models
+    :type selection: list
+    :type candidates: list
+    :type n_models: int
+    :type model_dir: string
+    :type cutoff: float
+    :type interface_cutoff: float
+    :type nproc: int
+    :return: Selected PDB names
+    :rtype: list
+    """
+    names = list(selection) + list(candidates)
+    if not candidates or len(selection) >= n_models:
+        return names[:n_models]
+    pdb_files = [f'{model_dir}/{pdb}' for pdb in names]
+    keys, coords = load_interface_ca(pdb_files, pdb_files[:max(len(selection), 1)], interface_cutoff, nproc)
+    logging.info(f'Comparing {len(candidates)} candidates on {len(keys)} interface Calpha atoms, '
+                 f'i-RMSD cutoff {cutoff:.2f}A')
+    selected = diverse_selection(coords, range(len(selection)), range(len(selection), len(names)), n_models, cutoff)
+    if len(selected) < n_models:
+        logging.warning(f'Only {len(selected)} models are more than {cutoff:.2f}A i-RMSD apart')
+    return [names[idx] for idx in selected]
@@ -0,0 +1,137 @@
+# Run filter_contacts and contact_analysis in a single process, keeping the data in memory between the stages
+import argparse
+import logging
+import os
+
+from contact_cache import DEFAULT_CACHE_DIR, evict_cache
+from contacts import DEFAULT_RADIUS, STORE_NAME, build_table, within_cutoff, write_store
+from filter_contacts import DEFAULT_FORBIDDEN, iter_contacts, load_forbidden, without_contacts, filter_contacts
+from contact_analysis import rank_models, rank_table, residue_frequencies, write_frequencies, write_restraints
+from haddock_files import read_file_nam, read_file_list
+from profiling import Profiler
+from run_archive import writable_path
+
+
+def calculate_contacts(model_dir, pdb_list, nproc=1, radius=DEFAULT_RADIUS, cache_dir=None, profiler=None):
+    """ Calculate the contacts of the models of a stage of a run, in the order of pdb_list
+
+    :param model_dir: Directory of the models, e.g. <run>/structures/it0
+    :param pdb_list: PDB names, as in file.nam
+    :param nproc: Number of processors
+    :param radius: Distance up to which the residue pairs are calculated, in Angstrom
+    :param cache_dir: Contact cache, None to disable it
+    :param profiler: Optional profiler the timings of every model are added to
+    :type model_dir: string
+    :type pdb_list: list
+    :type nproc: int
+    :type radius: float
+    :type cache_dir: string
+    :type profiler: Profiler
+    :return: Names of the models with contacts, their contact table and the PDB files that failed
+    :rtype: tuple
+    """
+    pdb_files = [f'{model_dir}/{pdb}' for pdb in pdb_list]
+    contacts = {}
+    failed_pdbs = []
+    cprofile_f = profiler.cprofile_f if profiler else None
+    for (pdb_file, pairs, error), timing in iter_contacts(pdb_files, nproc, radius, cache_dir, cprofile_f):
+        if profiler:
+            profiler.worker_done(timing)
+        if pairs is False:
+            logging.warning('Could not calculate contacts for %s: %s', os.path.basename(pdb_file),
+                            error or 'no contacts found')
+            failed_pdbs.append(pdb_file)
+            continue
+        contacts[pdb_file] = pairs
+
+    # failed models are left out, the others keep the order of file.nam
+    names = [os.path.basename(pdb_file) for pdb_file in pdb_files if pdb_file in contacts]
+    table = build_table((idx, contacts[f'{model_dir}/{pdb}']) for idx, pdb in enumerate(names))
+    return names, table, failed_pdbs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_directory", help='Location of the run')
+    parser.add_argument("--np", help='Number of processors to use', type=int, default=2)
+    parser.add_argument("--cutoff", help='Cutoff of forbidden contacts allowed in the PDB to be filtered, float between 0 and 1', type=float, default=.2)
+    parser.add_argument("--forbidden", help='JSON file with the forbidden regions as residue ranges', default=DEFAULT_FORBIDDEN)
+    parser.add_argument("--contact_cutoff", help='Distance cutoff in Angstrom used to define a contact', type=float, default=4.9)
+    parser.add_argument("--radius", help=f'Residue pairs are stored up to this distance in Angstrom, default={DEFAULT_RADIUS}', type=float, default=DEFAULT_RADIUS)
+    parser.add_argument("--cache_dir", help=f'Contact cache shared between runs, default={DEFAULT_CACHE_DIR}', default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--cache_size", help='Maximum size of the contact cache in MB, default=1024', type=int, default=1024)
+    parser.add_argument("--top", help='After ranking, how many models should be considered when counting contacts, several values can be given, default=100', type=int, nargs='+', default=[100])
+    parser.add_argument("--restraints", help='Residues in contact in the top models, per chain, default=restraints.tsv', default='restraints.tsv')
+    parser.add_argument("--restraints_top", help='Which --top value is used for the restraints, default=the smallest', type=int)
+    parser.add_argument("--min_fraction", help='Fraction of the top models a residue must be in contact with to be a restraint, default=0', type=float, default=0.)
+    parser.add_argument("--filtered_list", help='Also write the filtered models to this file, as filter_contacts.py does')
+    parser.add_argument("--frequencies", help='Also write the per-residue contact frequency table to this file, as contact_analysis.py does')
+    parser.add_argument("--profile", help='Write the time, memory and throughput of every stage to this JSON file')
+    parser.add_argument("--cprofile", help='With --profile, dump the cProfile statistics of the contact calculation to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='DEBUG',
+                        format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    restraints_top = args.restraints_top or min(args.top)
+    if restraints_top not in args.top:
+        args.top.append(restraints_top)
+
+    profiler = Profiler('pipeline', args.cprofile if args.profile else None)
+    it0 = f'{args.run_directory}/structures/it0'
+    radius = max(args.radius, args.contact_cutoff)
+
+    logging.info('Loading the models and their haddock-scores from %s', it0)
+    with profiler.stage('read_run') as stage:
+        pdb_list = read_file_nam(f'{it0}/file.nam')
+        haddockscore_dic = dict(read_file_list(f'{it0}/file.list'))
+        stage['items'] = len(pdb_list)
+
+    logging.info('Calculating contacts for %i PDBs using %i processors', len(pdb_list), args.np)
+    with profiler.stage('contacts', len(pdb_list), hot=True):
+        names, table, failed_pdbs = calculate_contacts(it0, pdb_list, args.np, radius, args.cache_dir, profiler)
+    if failed_pdbs:
+        logging.warning('%i models failed', len(failed_pdbs))
+
+    # the store is what filter_contacts.py would leave behind, later analyses of the run read it
+    logging.info('Writing the contacts of %i models to the contact store', len(names))
+    with profiler.stage('write_store', len(names)):
+        write_store(writable_path(f'{it0}/{STORE_NAME}'), names, table, radius)
+    with profiler.stage('evict_cache'):
+        evict_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    # the store keeps every residue pair up to the radius, the analysis only uses the contacts
+    table = within_cutoff(table, args.contact_cutoff)
+    empty = without_contacts(names, table)
+    if empty:
+        logging.warning('%i models have no contacts within %.2fA, they failed', len(empty), args.contact_cutoff)
+    forbidden_contacts = load_forbidden(args.forbidden)
+    with profiler.stage('filter_contacts', len(names)):
+        filtered = filter_contacts(names, table, forbidden_contacts, args.cutoff)
+    logging.info('%i of %i models passed the filter', len(filtered), len(names))
+    if args.filtered_list:
+        with open(args.filtered_list, 'w') as out_fh:
+            out_fh.write(''.join(f'{it0}/{pdb}\n' for pdb in filtered))
+
+    max_top = max(args.top)
+    if len(filtered) < max_top:
+        logging.warning('Only %i models passed the filter, all of them will be used.', len(filtered))
+    with profiler.stage('contact_analysis', len(filtered)):
+        top_models = rank_models(filtered, haddockscore_dic, max_top)
+        frequencies = residue_frequencies(rank_table(names, table, top_models), args.top, len(top_models))
+    for top in sorted(frequencies):
+        for chain in frequencies[top]:
+            contact_str = ','.join(map(str, frequencies[top][chain][0].tolist()))
+            logging.info('Top %i Chain %s - %s', top, chain, contact_str)
+    if args.frequencies:
+        write_frequencies(frequencies, args.frequencies)
+
+    logging.info('Writing the residues in contact in the top %i models to %s', restraints_top, args.restraints)
+    write_restraints(frequencies[restraints_top], args.restraints, args.min_fraction)
+
+    if args.profile:
+        logging.info('Writing the profile to %s', args.profile)
+        profiler.write(args.profile)
+
+    # done
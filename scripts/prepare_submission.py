@@ -1,35 +1,56 @@
 # load the models and the template, then prepare the submission
 import argparse
 import pandas as pd
-import itertools
-import subprocess
 import os
-import copy
 import logging
-import shutil
-
-
-def get_models(path):
+import functools
+import re
+import textwrap
+import numpy as np
+
+from haddock_files import read_file_list
+from interface_rmsd import INTERFACE_CUTOFF, remove_redundant
+from run_archive import map_run_files, open_run_file
+from profiling import Profiler, TimedWorker, worker_pool
+from structure import Structure
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    # scipy is optional, chain assignments are small enough for hungarian()
+    linear_sum_assignment = None
+
+# chain pairs sharing fewer k-mers than this are not aligned
+KMER_SIZE = 3
+KMER_MIN_SHARED = .1
+# the assignment maximizes identity, then coverage, then keeps the order of the chains
+COVERAGE_WEIGHT = 1e-6
+ORDER_WEIGHT = 1e-9
+
+# alignments computed once by the parent and handed to the pool workers, {(ref_seq, target_seq): alignment}
+_shared_alignments = {}
+
+
+def get_models(path, cluster_out=None):
     """ Find the selection inside the scoring folder structure
 
     :param pdb_l: List containing the selection as "01_01"
     :param path: Root location of the scoring
+    :param cluster_out: Clusters of the water models, default=the cluster.out of the run
     :type pdb_l: list
     :type path: string
+    :type cluster_out: string
     :return: Actual filename of the structure, ex: target164-scoring_0921_conv.pdb
     :rtype: list
     """
     # relate models with their cluster
     file_dic = {}
-    with open(f'{path}/structures/it1/water/file.list', 'r') as fh:
-        for idx, element in enumerate(fh.readlines()):
-            score = float(element.split()[-2])
-            pdb = element.split()[0].split(':')[-1][:-1]
-            file_dic[idx + 1] = (pdb, score)
-            # file_list.append((idx, pdb, score))
+    for idx, (pdb, score) in enumerate(read_file_list(f'{path}/structures/it1/water/file.list')):
+        file_dic[idx + 1] = (pdb, score)
 
     cluster_dic = {}
-    with open(f'{path}/structures/it1/water/analysis/cluster.out') as fh:
+    cluster_out = cluster_out or f'{path}/structures/it1/water/analysis/cluster.out'
+    with open_run_file(cluster_out) as fh:
         for line in fh.readlines():
             cluster_id = int(line.split()[1])
             cluster_elements = list(map(int, line.split()[4:]))
@@ -45,6 +66,11 @@ def get_models(path):
 
     cluster_scores.sort(key=lambda x: x[1])
 
+    # the single-structure ranking of a PDB is the position where it first appears in file.list
+    rank_dic = {}
+    for single_structure_ranking in file_dic:
+        rank_dic.setdefault(file_dic[single_structure_ranking][0], single_structure_ranking)
+
     structure_list = []
     for overall_cluster_ranking, cluster_id in enumerate(cluster_scores):
         cluster_id, _ = cluster_id
@@ -52,10 +78,9 @@ def get_models(path):
         for internal_cluster_ranking, cluster_element in enumerate(cluster_dic[cluster_id]):
             internal_cluster_ranking += 1
             pdb = file_dic[cluster_element][0]
-            single_structure_ranking = [e for e in file_dic if file_dic[e][0] == pdb][0]
-            structure_list.append((pdb, single_structure_ranking, overall_cluster_ranking, internal_cluster_ranking))
-    
-    done_pdbs = [e[0] for e in structure_list]
+            structure_list.append((pdb, rank_dic[pdb], overall_cluster_ranking, internal_cluster_ranking))
+
+    done_pdbs = set(e[0] for e in structure_list)
 
     for single_structure_ranking in file_dic:
         pdb, _ = file_dic[single_structure_ranking]
@@ -65,300 +90,518 @@ def get_models(path):
     return structure_list
 
 
-def pad_line(line):
-    """Helper function to pad line to 80 characters in case it is shorter, borrowed from from pdb-tools (:
+def select_models(df, n_clusters=5, n_models=100, fill=None):
+    """ Select the top 2 models of the best clusters, interleaved, then fill with the best single structures
 
-    :param line: Line extracted from a PDB file
-    :type line: string
-    :return: Padded line
-    :rtype: string
+    :param df: Dataframe with the data returned by get_models
+    :param n_clusters: How many of the best clusters contribute their top 2 models
+    :param n_models: Size of the selection
+    :param fill: Optional function (selection, candidates, n_models) -> selection used to fill the selection
+        instead of taking the candidates in order, e.g. interface_rmsd.remove_redundant
+    :type df: pandas.DataFrame
+    :type n_clusters: int
+    :type n_models: int
+    :type fill: function
+    :return: Selected PDB names
+    :rtype: list
     """
-    size_of_line = len(line)
-    if size_of_line < 80:
-        padding = 80 - size_of_line + 1
-        line = line.strip('\n') + ' ' * padding + '\n'
-    return line[:81]  # 80 + newline character
+    # top1 of cluster 1, top2 of cluster 1, top1 of cluster 2, ...
+    top_clusters = df[(df['overall_cluster_ranking'] <= n_clusters) & (df['internal_cluster_ranking'] <= 2)]
+    top_clusters = top_clusters.sort_values(by=['overall_cluster_ranking', 'internal_cluster_ranking'], kind='stable')
+    selection = top_clusters['pdb'].drop_duplicates().tolist()[:n_models]
+
+    # fill with the remaining models by single-structure ranking
+    single_structure_sorted_df = df.sort_values(by='single_structure_ranking', kind='stable')
+    remaining = single_structure_sorted_df['pdb'][~single_structure_sorted_df['pdb'].isin(selection)]
+    if fill:
+        selection = fill(selection, remaining.drop_duplicates().tolist(), n_models)
+    else:
+        selection += remaining.drop_duplicates().tolist()[:n_models - len(selection)]
 
+    if len(selection) < n_models:
+        logging.warning(f'Only {len(selection)} models available, the selection will be smaller than {n_models}')
+    return selection
 
-def identify_chains(pdb_f):
-    """" Read PDB structure and return its chainIDs
 
-    :param pdb_f: PDB filename
-    :type pdb_f: string
+def identify_chains(structure):
+    """" Return the chainIDs of a structure
+
+    :param structure: Parsed PDB
+    :type structure: Structure
     :return: List with chains found on the input PDB
     :rtype: list
     """
-    chainid_l = []
-    with open(pdb_f) as fh:
-        for line in fh.readlines():
-            if line.startswith('ATOM'):
-                line = pad_line(line)
-                chainid = line[21].strip()[:1]
-                if not chainid.isdigit():  # ignore NUMERICAL chains
-                    chainid_l.append(chainid)
-
-    chainid_l = list(set(chainid_l))
     # WARNING: This expects chains to be sequential!
     # chain1 = A, chain2 = B or chain1 = D, chain = E, etc
-    chainid_l.sort()
-    return chainid_l
+    return structure.chain_ids()
 
 
-def load_seq(pdb_f):
-    """ Load a PDB filename into a dictionary {chain: {resnum: resname}}
+def load_seq(structure):
+    """ Load the sequences of a structure into a dictionary {chain: (resnums, sequence)}
 
-    :param pdb_f: PDB file name
-    :type pdb_f: string
-    :return: {chain: {resnum: resname}}
+    :param structure: Parsed PDB
+    :type structure: Structure
+    :return: {chain: (resnums, sequence)}
     :rtype: dict
     """
-    aa_dic = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLU': 'E', 'GLN': 'Q', 'GLY': 'G',
-              'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
-              'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V', 'DC': 'C', 'DA': 'A', 'DG': 'G', 'DT': 'T',
-              'ADE': 'A', 'THY': 'T', 'GUA': 'G', 'CYT': 'C'}
-    seq_dic = {}
-    for l in open(pdb_f):
-        if 'ATOM' in l[:4]:
-            chain = l[21]
-            resnum = int(l[22:26])
-            resname = l[17:20].split()[0]
-            if chain not in seq_dic:
-                seq_dic[chain] = {}
-            try:
-                name = aa_dic[resname]
-            except KeyError:
-                name = 'X'
-            seq_dic[chain][resnum] = name
-
-    return seq_dic
-
-
-def replace_chain(pdbf, old_chain, new_chain, overwrite=True):
-    """ Replace a specified chain with a new one in a PDB file
-
-    :param pdbf: PDB filename
-    :param old_chain: Old chain
-    :param new_chain: New chain
-    :param overwrite: Overwrite the PDB or create a new one
-    :type pdbf: string
-    :type old_chain: string
-    :type new_chain: string
-    :type overwrite: bool
-    :return: Replaced PDB filename
-    :rtype: string
+    return {chain: structure.sequence(chain) for chain in structure.chain_residues}
+
+
+def capri51_rechain(chain, resnum):
+    """ Rechain a residue of the final docking run, the regions matching the template get a letter and the rest
+        a number so they are ignored when matching
+
+    WARNING: This here is a hardcoded bypass specifically for CAPRI51 Target183
+
+    :param chain: Chain of the residue
+    :param resnum: Residue number
+    :type chain: string
+    :type resnum: int
+    :return: New chain and residue number
+    :rtype: tuple
+    """
+    if chain == 'A':
+        chain = 'X' if 2282 <= resnum < 2397 else '0'
+    elif chain == 'B':
+        chain = 'Y' if 576 <= resnum < 845 else '1'
+    return chain, resnum
+
+
+def residue_map(structure, chain_matches, rechain=None):
+    """ Precompute where every residue of a model goes after rechaining, chain replacement and renumbering
+
+    The template chains are applied in order, as replacing and renumbering them one after the other would.
+
+    :param structure: Parsed model
+    :param chain_matches: List of (template_chain, model_chain, numbering_dic) as returned by match_chains
+    :param rechain: Optional function (chain, resnum) -> (chain, resnum) applied first
+    :type structure: Structure
+    :type chain_matches: list
+    :type rechain: function
+    :return: New chain, new residue number and whether it is kept for every residue, and the discarded
+        residues per template chain
+    :rtype: tuple
     """
-    new_pdb = pdbf + '_'
-    with open(new_pdb, 'w') as out_fh:
-        with open(pdbf) as in_fh:
-            for line in in_fh.readlines():
-                if line.startswith('ATOM'):
-                    current_chain = line[21]
-                    if current_chain == old_chain:
-                        line = line[:21] + new_chain + line[22:]
-                out_fh.write(line)
-        in_fh.close()
-    out_fh.close()
-
-    if overwrite:
-        os.rename(new_pdb, pdbf)
-        return pdbf
+    n_residues = len(structure.residues)
+    new_chains = np.empty(n_residues, dtype='U1')
+    new_resnums = np.empty(n_residues, dtype=np.int64)
+    keep = np.ones(n_residues, dtype=bool)
+    ignored_res = {}
+    residues = zip(structure.residues['chain'].tolist(), structure.residues['resnum'].tolist())
+    for res_idx, (chain, resnum) in enumerate(residues):
+        new_chain, new_resnum = rechain(chain, resnum) if rechain else (chain, resnum)
+        for ref_chain, old_chain, numbering_dic in chain_matches:
+            if new_chain == old_chain:
+                new_chain = ref_chain
+            if new_chain == ref_chain:
+                if new_resnum not in numbering_dic:
+                    # Residue not found in reference, IGNORE
+                    ignored_res.setdefault(ref_chain, []).append(new_resnum)
+                    keep[res_idx] = False
+                    break
+                new_resnum = numbering_dic[new_resnum]
+        new_chains[res_idx] = new_chain
+        new_resnums[res_idx] = new_resnum
+    return new_chains, new_resnums, keep, ignored_res
+
+
+@functools.lru_cache(maxsize=None)
+def align(ref_seq, target_seq, match_score=5, mismatch_score=-4, gap_open=11, gap_extend=1):
+    """ Global alignment of two sequences (Needleman-Wunsch with affine gaps, end gaps are free)
+
+    Each row of the dynamic programming matrix is computed at once with NumPy, the gaps along a row are
+    resolved with a cumulative maximum. Results are memoized, every unique pair of sequences is aligned once.
+
+    :param ref_seq: Reference sequence
+    :param target_seq: Target sequence
+    :param match_score: Score of identical residues
+    :param mismatch_score: Score of different residues
+    :param gap_open: Penalty of the first position of a gap
+    :param gap_extend: Penalty of every other position of a gap
+    :type ref_seq: string
+    :type target_seq: string
+    :type match_score: int
+    :type mismatch_score: int
+    :type gap_open: int
+    :type gap_extend: int
+    :return: Aligned reference, aligned target and the number of identical aligned positions
+    :rtype: tuple
+    """
+    n, m = len(ref_seq), len(target_seq)
+    neg_inf = -(10 ** 9)
+    target_arr = np.frombuffer(target_seq.encode('ascii'), dtype=np.uint8)
+    steps = np.arange(m + 1)
+
+    # H = best score, D = diagonal, F = gap in the target (vertical), E = gap in the reference (horizontal)
+    D = np.full((n + 1, m + 1), neg_inf, dtype=np.int64)
+    F = np.full((n + 1, m + 1), neg_inf, dtype=np.int64)
+    E = np.full((n + 1, m + 1), neg_inf, dtype=np.int64)
+    H = np.zeros((n + 1, m + 1), dtype=np.int64)
+    for i in range(1, n + 1):
+        scores = np.where(target_arr == ord(ref_seq[i - 1]), match_score, mismatch_score)
+        D[i, 1:] = H[i - 1, :-1] + scores
+        F[i, 1:] = np.maximum(F[i - 1, 1:] - gap_extend, H[i - 1, 1:] - gap_open)
+        G = np.maximum(D[i], F[i])
+        G[0] = 0
+        best_open = np.maximum.accumulate(G + gap_extend * steps)
+        E[i, 1:] = best_open[:-1] - gap_open - gap_extend * (steps[1:] - 1)
+        H[i] = np.maximum(G, E[i])
+        H[i, 0] = 0
+
+    # trailing end gaps are free, start from the best cell of the last row or column
+    if H[n].max() >= H[:, m].max():
+        i, j = n, int(H[n].argmax())
     else:
-        return new_pdb
+        i, j = int(H[:, m].argmax()), m
+    ref_aln = [ref_seq[k] for k in range(n - 1, i - 1, -1)] + ['-'] * (m - j)
+    target_aln = ['-'] * (n - i) + [target_seq[k] for k in range(m - 1, j - 1, -1)]
+
+    state = 'H'
+    while i > 0 and j > 0:
+        if state == 'H':
+            if H[i, j] == D[i, j]:
+                state = 'D'
+            elif H[i, j] == F[i, j]:
+                state = 'F'
+            else:
+                state = 'E'
+        if state == 'D':
+            ref_aln.append(ref_seq[i - 1])
+            target_aln.append(target_seq[j - 1])
+            i, j = i - 1, j - 1
+            state = 'H'
+        elif state == 'F':
+            ref_aln.append(ref_seq[i - 1])
+            target_aln.append('-')
+            state = 'H' if F[i, j] == H[i - 1, j] - gap_open else 'F'
+            i -= 1
+        else:
+            # find where this gap was opened, that cell cannot be itself a horizontal gap
+            k = j - 1
+            while k > 0 and max(D[i, k], F[i, k]) - gap_open - gap_extend * (j - k - 1) != E[i, j]:
+                k -= 1
+            ref_aln.extend(['-'] * (j - k))
+            target_aln.extend(target_seq[k:j][::-1])
+            j = k
+            state = 'D' if D[i, j] >= F[i, j] else 'F'
+
+    # leading end gaps
+    ref_aln.extend(ref_seq[i - 1::-1] if i else '')
+    target_aln.extend(['-'] * i)
+    ref_aln.extend(['-'] * j)
+    target_aln.extend(target_seq[j - 1::-1] if j else '')
+
+    ref_aln = ''.join(ref_aln[::-1])
+    target_aln = ''.join(target_aln[::-1])
+    identical = sum(1 for a, b in zip(ref_aln, target_aln) if a == b and a != '-')
+    return ref_aln, target_aln, identical
+
+
+@functools.lru_cache(maxsize=None)
+def kmer_set(seq, k=KMER_SIZE):
+    """ Distinct k-mers of a sequence, memoized as the same chains come back in every model """
+    return frozenset(seq[i:i + k] for i in range(len(seq) - k + 1))
+
+
+def kmer_similarity(ref_seq, target_seq, k=KMER_SIZE):
+    """ Fraction of the distinct k-mers of the shorter sequence that are also in the other one
+
+    :param ref_seq: Reference sequence
+    :param target_seq: Target sequence
+    :param k: k-mer length
+    :type ref_seq: string
+    :type target_seq: string
+    :type k: int
+    :return: Shared fraction, 1 when a sequence is too short to have k-mers
+    :rtype: float
+    """
+    ref_kmers, target_kmers = kmer_set(ref_seq, k), kmer_set(target_seq, k)
+    if not ref_kmers or not target_kmers:
+        return 1.
+    return len(ref_kmers & target_kmers) / min(len(ref_kmers), len(target_kmers))
 
 
-def renumber(pdbf, renumber_dic, target_chain, overwrite=True):
-    """ Renumber a specific chain of a PDB file based on a reference dictionary
+def hungarian(cost):
+    """ Minimum cost one-to-one assignment of the rows of a cost matrix to its columns (Kuhn-Munkres)
 
-    :param pdbf: PDB filename
-    :param renumber_dic: Reference dicionary {template_resnum: target_resnum}
-    :param target_chain: Chain to be renumbered
-    :param overwrite: Overwrite the PDB or create a new one
-    :type pdbf: string
-    :type renumber_dic: dict
-    :type target_chain: string
-    :type overwrite: bool
-    :return: The renumbered PDB filename
-    :rtype: string
+    Used when scipy is not available, the matrices are as small as the number of chains.
+
+    :param cost: (n, m) cost matrix with n <= m
+    :type cost: numpy.ndarray
+    :return: Row indexes and their assigned column indexes
+    :rtype: tuple
     """
-    new_pdb = pdbf + '_'
-    ignored_res = []
-    with open(new_pdb, 'w') as out_fh:
-        with open(pdbf) as in_fh:
-            for line in in_fh.readlines():
-                if line.startswith('ATOM'):
-                    current_res = int(line[22:26])
-                    current_chain = line[21]
-                    if current_chain == target_chain:
-                        try:
-                            new_res = renumber_dic[current_res]
-                            line = line[:22] + '{:>4}'.format(new_res) + line[26:]
-                            out_fh.write(line)
-                        except:
-                            # Residue not found in reference, IGNORE
-                            ignored_res.append(current_res)
-                    else:
-                        out_fh.write(line)
-                else:
-                    out_fh.write(line)
-        in_fh.close()
-    out_fh.close()
-
-    if ignored_res:
-        ignored_res_str = ', '.join(map(str, list(set(ignored_res))))
-        logging.warning(f'{pdbf} Chain {target_chain} Res {ignored_res_str} not found in reference, discarded.')
-
-    if overwrite:
-        os.rename(new_pdb, pdbf)
-        return pdbf
-    else:
-        return new_pdb
+    n, m = cost.shape
+    # potentials of the rows (u) and columns (v), column_row[j] is the row assigned to column j (1-based, 0 = free)
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    column_row = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for row in range(1, n + 1):
+        column_row[0] = row
+        free_column = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while column_row[free_column]:
+            used[free_column] = True
+            current_row = column_row[free_column]
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            better = ~used[1:] & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = free_column
+            candidates = np.where(used[1:], np.inf, min_slack[1:])
+            next_column = int(candidates.argmin()) + 1
+            delta = candidates[next_column - 1]
+            u[column_row[used]] += delta
+            v[used] -= delta
+            min_slack[1:][~used[1:]] -= delta
+            free_column = next_column
+        while free_column:
+            previous = way[free_column]
+            column_row[free_column] = column_row[previous]
+            free_column = previous
+    columns = np.nonzero(column_row[1:])[0]
+    rows = column_row[1:][columns] - 1
+    order = np.argsort(rows)
+    return rows[order], columns[order]
+
+
+def assign_chains(score):
+    """ Optimal one-to-one assignment maximizing the total score, with scipy's solver when available
+
+    :param score: (template chains, model chains) score matrix
+    :type score: numpy.ndarray
+    :return: Template chain indexes and their assigned model chain indexes
+    :rtype: tuple
+    """
+    transposed = score.shape[0] > score.shape[1]
+    cost = -(score.T if transposed else score)
+    rows, columns = linear_sum_assignment(cost) if linear_sum_assignment else hungarian(cost)
+    if transposed:
+        order = np.argsort(columns)
+        return columns[order], rows[order]
+    return rows, columns
+
+
+def numbering(ref_resnums, target_resnums, ref_aln, target_aln):
+    """ Translate an alignment into a residue numbering dictionary {target_resnum: ref_resnum} """
+    counter_a = 0
+    counter_b = 0
+    numbering_dic = {}
+    for ref_char, target_char in zip(ref_aln, target_aln):
+        # '-' once a sequence is exhausted
+        ref_resnum = ref_resnums[counter_a] if counter_a < len(ref_resnums) else '-'
+        target_resnum = target_resnums[counter_b] if counter_b < len(target_resnums) else '-'
+
+        if '-' not in ref_char:
+            counter_a += 1
+        if '-' not in target_char:
+            counter_b += 1
+        if '-' not in ref_char and '-' not in target_char:
+            numbering_dic[target_resnum] = ref_resnum
+    return numbering_dic
+
+
+def candidate_pairs(template_seq_dic, template_chains, pdb_seq_dic, pdb_chains):
+    """ Chain pairs worth aligning, those sharing enough k-mers (all the pairs of a template chain when none does)
+
+    :param template_seq_dic: Sequences of the template as returned by load_seq
+    :param template_chains: Chains of the template as returned by identify_chains
+    :param pdb_seq_dic: Sequences of the model as returned by load_seq
+    :param pdb_chains: Chains of the model as returned by identify_chains
+    :type template_seq_dic: dict
+    :type template_chains: list
+    :type pdb_seq_dic: dict
+    :type pdb_chains: list
+    :return: (template chain index, model chain index) pairs
+    :rtype: list
+    """
+    pairs = []
+    for i, ref_chain in enumerate(template_chains):
+        ref_seq = template_seq_dic[ref_chain][1]
+        plausible = [j for j, target_chain in enumerate(pdb_chains)
+                     if kmer_similarity(ref_seq, pdb_seq_dic[target_chain][1]) >= KMER_MIN_SHARED]
+        pairs += [(i, j) for j in plausible or range(len(pdb_chains))]
+    return pairs
+
+
+def share_alignments(alignments):
+    """ Pool initializer, the workers start with the alignments computed by the parent """
+    _shared_alignments.update(alignments)
+
+
+def match_chains(template_seq_dic, template_chains, pdb_seq_dic, pdb_chains):
+    """ Use sequence alignment to find which chain of a model corresponds to each template chain
+
+    Only the chain pairs that share enough k-mers are aligned, the other pairs are obviously unrelated (all the
+    pairs of a template chain are aligned when none passes). The chains are then matched one-to-one, maximizing
+    the total identity; coverage and then the order of the chains break the ties, so identical chains of a
+    homo-oligomer are matched in order.
+
+    :param template_seq_dic: Sequences of the template as returned by load_seq
+    :param template_chains: Chains of the template as returned by identify_chains
+    :param pdb_seq_dic: Sequences of the model as returned by load_seq
+    :param pdb_chains: Chains of the model as returned by identify_chains
+    :type template_seq_dic: dict
+    :type template_chains: list
+    :type pdb_seq_dic: dict
+    :type pdb_chains: list
+    :return: List of (template_chain, model_chain, numbering_dic) with numbering_dic {model_resnum: template_resnum}
+    :rtype: list
+    """
+    score = np.zeros((len(template_chains), len(pdb_chains)))
+    numbering_dics = {}
+    for i, j in candidate_pairs(template_seq_dic, template_chains, pdb_seq_dic, pdb_chains):
+        ref_chain, target_chain = template_chains[i], pdb_chains[j]
+        ref_resnums, ref_seq = template_seq_dic[ref_chain]
+        target_resnums, target_seq = pdb_seq_dic[target_chain]
+
+        alignment = _shared_alignments.get((ref_seq, target_seq)) or align(ref_seq, target_seq)
+        ref_aln, target_aln, identical = alignment
+        numbering_dic = numbering(ref_resnums, target_resnums, ref_aln, target_aln)
+        identity = identical / float(len(ref_seq))
+        coverage = len(numbering_dic) / len(ref_aln)
+        logging.debug(f"{ref_chain}, {target_chain}, {identity}, {coverage}")
+
+        numbering_dics[i, j] = numbering_dic
+        # identity differences are at least 1 / len(ref_seq), far above the tie breakers
+        score[i, j] = identity + COVERAGE_WEIGHT * coverage + ORDER_WEIGHT * (i == j)
+
+    chain_matches = []
+    for i, j in zip(*assign_chains(score)):
+        if (i, j) not in numbering_dics:
+            # only left over unrelated chains
+            continue
+        chain_matches.append((template_chains[i], pdb_chains[j], numbering_dics[i, j]))
+    matched = set(ref_chain for ref_chain, _, _ in chain_matches)
+    for ref_chain in template_chains:
+        if ref_chain not in matched:
+            logging.warning(f'No chain of the model matches the template chain {ref_chain}')
+    return chain_matches
+
+
+def read_model(pdb, rechain=None):
+    """ Read a model with its sequences and chains as they are after rechaining, without writing it to disk
+
+    :param pdb: PDB filename
+    :param rechain: Optional function (chain, resnum) -> (chain, resnum)
+    :type pdb: string
+    :type rechain: function
+    :return: The parsed model, its sequences as returned by load_seq and its chains as returned by identify_chains
+    :rtype: tuple
+    """
+    model = Structure.from_pdb(pdb)
+    rechained = model
+    if rechain:
+        residues = zip(model.residues['chain'].tolist(), model.residues['resnum'].tolist())
+        rechained = model.with_chains([rechain(chain, resnum)[0] for chain, resnum in residues])
+    return model, load_seq(rechained), identify_chains(rechained)
+
+
+def model_sequences(pdb, rechain=None):
+    """ Sequences and chains of a model as they are after rechaining, see read_model
+
+    :param pdb: PDB filename
+    :param rechain: Optional function (chain, resnum) -> (chain, resnum)
+    :type pdb: string
+    :type rechain: function
+    :return: The sequences as returned by load_seq and the chains as returned by identify_chains
+    :rtype: tuple
+    """
+    _, pdb_seq_dic, pdb_chains = read_model(pdb, rechain)
+    return pdb_seq_dic, pdb_chains
+
+
+def match_model(pdb, template_seq_dic, template_chains, output_dir, rechain=None):
+    """ Match a single model to the template and write it renumbered, the model is read once and written once
+
+    :param pdb: PDB filename
+    :param template_seq_dic: Template sequences as returned by load_seq
+    :param template_chains: Template chains as returned by identify_chains
+    :param output_dir: Directory where the matched model is written
+    :param rechain: Optional function (chain, resnum) -> (chain, resnum) applied before matching
+    :type pdb: string
+    :type template_seq_dic: dict
+    :type template_chains: list
+    :type output_dir: string
+    :type rechain: function
+    :return: The matched/renumbered PDB filename and the discarded residues per chain
+    :rtype: tuple
+    """
+    model, pdb_seq_dic, pdb_chains = read_model(pdb, rechain)
+    chain_matches = match_chains(template_seq_dic, template_chains, pdb_seq_dic, pdb_chains)
+
+    new_chains, new_resnums, keep, ignored_res = residue_map(model, chain_matches, rechain)
 
+    output_pdb = os.path.join(output_dir, os.path.basename(pdb))
+    #  Note, if residue is present in target and not in reference it will be DELETED, use with caution
+    model.write(output_pdb, new_chains, new_resnums, keep)
+    return output_pdb, ignored_res
 
-def match(pdb_l, template):
-    """ Use sequence alignment to match the selection to the provided template by calculating the identity of them
-        with a combinatorial product
+
+def match(pdb_l, template, output_dir, rechain=None, nproc=1, profiler=None):
+    """ Match the selection to the provided template and write the renumbered models
 
     :param pdb_l: List containing multiple PDB filenames
-    :param template: CAPRI .brk template filename
+    :param template: Parsed CAPRI .brk template
+    :param output_dir: Directory where the matched models are written
+    :param rechain: Optional function (chain, resnum) -> (chain, resnum) applied before matching, must be
+        defined at module level when nproc > 1
+    :param nproc: Number of processors, models are matched independently
+    :param profiler: Optional profiler the timings of every model are added to
     :type pdb_l: list
-    :type template: string
-    :return: List of the matched/renumbered PDB filenames
+    :type template: Structure
+    :type output_dir: string
+    :type rechain: function
+    :type nproc: int
+    :type profiler: Profiler
+    :return: List of the matched/renumbered PDB filenames, in the same order as pdb_l
     :rtype: list
     """
-    # TODO: Improve the readability of this function
-    match_l = []
+    if not pdb_l:
+        return []
+    # the template is only parsed here, the workers get its sequences
     template_seq_dic = load_seq(template)
     template_chains = identify_chains(template)
-    for pdb in pdb_l:
-        pdb_seq_dic = load_seq(pdb)
-        pdb_chains = identify_chains(pdb)
-        identity_dic = {}
-        for ref_chain, target_chain in itertools.product(template_chains, pdb_chains):
-
-            ref_seq = ''.join(list(template_seq_dic[ref_chain].values()))
-            target_seq = ''.join(list(pdb_seq_dic[target_chain].values()))
-
-            # TODO: use python's tempfile
-            open('seq.fasta', 'w').write(f'>ref\n{ref_seq}\n>target\n{target_seq}\n')
-
-            cmd = '/Users/rodrigo/software/clustalo -i seq.fasta --outfmt=clu --resno --wrap=9000 --force'
-            # logging.debug(f'Running align command {cmd}')
-            p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out = p.communicate()
-            os.remove('seq.fasta')
-
-            aln_data = out[0].decode('utf-8').split()
-            ref_aln = aln_data[6]
-            target_aln = aln_data[9]
-            counter_a = 0
-            counter_b = 0
-            numbering_dic = {}
-            for i in range(len(ref_aln)):
-                ref_char = ref_aln[i]
-                target_char = target_aln[i]
-                try:
-                    ref_resnum = list(template_seq_dic[ref_chain])[counter_a]
-                except IndexError:
-                    # Ref sequence exhausted, ignore
-                    ref_resnum = '-'
-                try:
-                    target_resnum = list(pdb_seq_dic[target_chain])[counter_b]
-                except IndexError:
-                    # Target sequence exhausted, ignore
-                    target_resnum = '-'
-
-                if '-' not in ref_char:
-                    counter_a += 1
-                if '-' not in target_char:
-                    counter_b += 1
-                if '-' not in ref_char and '-' not in target_char:
-                    numbering_dic[target_resnum] = ref_resnum
-
-            identity = out[0].decode('utf-8').count('*') / float(len(ref_seq))
-            coverage = len(numbering_dic) / len(ref_aln)
-
-            logging.debug(f"{ref_chain}, {target_chain}, {identity}, {coverage}")
-            # logging.debug(f'>R:{ref_chain}\n{ref_aln}')
-            # logging.debug(f'>T:{target_chain}\n{target_aln}')
-
-            try:
-                identity_dic[ref_chain].append((target_chain, identity, coverage, numbering_dic))
-            except KeyError:
-                identity_dic[ref_chain] = [(target_chain, identity, coverage, numbering_dic)]
-
-        for i, ref_c in enumerate(template_chains):
-            target_info_list = [(v[0], v[1], v[2]) for v in identity_dic[ref_c]]
-            # sort by identity and coverage
-            sorted_target_list = sorted(target_info_list, key=lambda x: (-x[2], x[1]))
-            # create a catalog with possible numbering references
-            numbering_dic_catalog = dict([(v[0], v[3]) for v in identity_dic[ref_c]])
-
-            if len(set([e[1] for e in sorted_target_list])) == 1:
-                # this is a homo-something, match is sequentialy
-                selected_chain = pdb_chains[i]
-            else:
-                # get the highest identity/coverage
-                selected_chain = sorted_target_list[0][0]
-
-            # select the correct numbering dictionary
-            selected_numbering_dic = numbering_dic_catalog[selected_chain]
-            # just for readability:
-            old_chain = selected_chain
-            new_chain = ref_c
-
-            # replace the target chain (old) with the same observed in the reference (new)
-            chain_matched_pdb = replace_chain(pdb, old_chain, new_chain, overwrite=True)
-
-            # renumber!
-            #  Note, if residue is present in target and not in reference it will be DELETED, use with caution
-            renumbered_pdb = renumber(chain_matched_pdb, selected_numbering_dic, new_chain, overwrite=True)
+    worker = TimedWorker(functools.partial(match_model, template_seq_dic=template_seq_dic,
+                                           template_chains=template_chains, output_dir=output_dir, rechain=rechain))
+    if nproc > 1:
+        chunksize = max(1, len(pdb_l) // (nproc * 4))
+        # models of a run mostly share their sequences, every distinct chain pair of the selection is aligned once
+        #  here and the alignments are shared with every worker
+        with worker_pool(nproc) as pool:
+            sequences = list(map_run_files(functools.partial(model_sequences, rechain=rechain), pdb_l,
+                                           functools.partial(pool.imap, chunksize=chunksize)))
+        alignments = {}
+        seen = set()
+        for pdb_seq_dic, pdb_chains in sequences:
+            model_seqs = tuple(pdb_seq_dic[chain][1] for chain in pdb_chains)
+            if model_seqs in seen:
+                continue
+            seen.add(model_seqs)
+            for i, j in candidate_pairs(template_seq_dic, template_chains, pdb_seq_dic, pdb_chains):
+                ref_seq, target_seq = template_seq_dic[template_chains[i]][1], pdb_seq_dic[pdb_chains[j]][1]
+                if (ref_seq, target_seq) not in alignments:
+                    alignments[ref_seq, target_seq] = align(ref_seq, target_seq)
+
+        # the warnings are logged here, in order
+        with worker_pool(nproc, profiler.cprofile_f if profiler else None, share_alignments, (alignments,)) as pool:
+            results = list(map_run_files(worker, pdb_l, functools.partial(pool.imap, chunksize=chunksize)))
+    else:
+        results = map_run_files(worker, pdb_l)
 
-            if renumbered_pdb not in match_l:
-                match_l.append(renumbered_pdb)
+    match_l = []
+    for pdb, ((output_pdb, ignored_res), timing) in zip(pdb_l, results):
+        if profiler:
+            profiler.worker_done(timing)
+        for chain in ignored_res:
+            ignored_res_str = ', '.join(map(str, list(set(ignored_res[chain]))))
+            logging.warning(f'{pdb} Chain {chain} Res {ignored_res_str} not found in reference, discarded.')
+        match_l.append(output_pdb)
 
     return match_l
 
 
-def create_ensemble(pdb_l, ensemble_name):
-    """ Join a list of PDBs to create an ensemble with pdb_mkensemble
-
-    :param pdb_l: List containing the PDB filenames to be made into an ensemble
-    :param ensemble_name: Filename of the ensemble to be generated
-    :type pdb_l: list 
-    :type ensemble_name: string  
-    :return: True if ensemble was generated
-    :rtype: bool
-    """
-    pdb_str = ' '.join(pdb_l)
-    cmd = f'pdb_mkensemble {pdb_str}'
-    logging.debug(f'Create ensemble with command {cmd}')
-    output_f = open(ensemble_name, 'w')
-    p = subprocess.Popen(cmd.split(), stdout=output_f, stderr=subprocess.PIPE)
-    p.communicate()
-    if not os.path.isfile(ensemble_name):
-        logging.error(f'Could not generate the ensemble {ensemble_name}')
-    return True
-
-
-def add_csb_header(submission):
-    """ Add the CSB Header into a string containg already the Capri Header and the PDB Ensemble
-
-    :param submission: String containing the HEADER and the ENSEMBLE
-    :type submission: string
-    :return: Capri HEADER + CSB HEADER + Ensemble
-    :rtype: string
-    """
-    # The CSB header must be added right after the COMPND remark
-    pos = 0
-    submission_aslist = submission.split('\n')
-    for l in submission_aslist:
-        if not l.startswith('COMPND'):
-            continue
-        else:
-            pos += 1
-    return '\n'.join(submission_aslist[:pos + 1] + [csb_header()] + submission_aslist[pos + 1:])
-
-
 def csb_header():
     """ The CSB Header used for CAPRI Scorer Submission
 
@@ -386,123 +629,142 @@ REMARK   3  REF    J.Mol.Biol., 428, 720-725 (2015).'''
     return ''.join(header)
 
 
-def tidy(pdb_f):
-    cmd = f'pdb_tidy {pdb_f}'
-    logging.debug(f'Tidying up with command {cmd}')
-    tidy_output_f = open(f'{pdb_f}_', 'w')
-    p = subprocess.Popen(cmd.split(), stdout=tidy_output_f, stderr=subprocess.PIPE)
-    p.communicate()
-    if not os.path.isfile(f'{pdb_f}_'):
-        logging.error(f'Could not generate the tidy PDB  {pdb_f}_')
-    else:
-        shutil.move(f'{pdb_f}_', pdb_f)
-        return True
+def pdb_record(line):
+    """ Pad a record to 80 columns, longer records are wrapped keeping their record name (same as pdb_tidy)
+
+    :param line: PDB record
+    :type line: string
+    :return: The record(s), each ending with a newline
+    :rtype: string
+    """
+    line = line.strip()
+    if len(line) <= 80:
+        return f'{line:<80}\n'
+    prefix = re.match(r'\S+\s*', line).group(0)
+    width = 80 - len(prefix)
+    return ''.join(f'{prefix}{part:<{width}}\n' for part in textwrap.wrap(line[len(prefix):], width=width))
+
+
+def model_records(pdb_f):
+    """ Stream the ATOM records of a model with TER records at chain breaks and gaps (same as pdb_tidy)
+
+    :param pdb_f: PDB filename
+    :type pdb_f: string
+    :return: Generator of the records
+    :rtype: generator
+    """
+    ter_fmt = 'TER  {:>6d}      {:3s} {:1s}{:>4s}{:1s}'
+    serial_offset = 0
+    prev_line = None
+    with open(pdb_f) as fh:
+        for line in fh:
+            if not line.startswith('ATOM'):
+                continue
+            line = line.rstrip('\n')
+            if prev_line is not None and (line[21] != prev_line[21] or int(line[22:26]) - int(prev_line[22:26]) > 1):
+                # TER takes the serial after the last atom, the atoms that follow are shifted by one
+                serial_offset += 1
+                yield pdb_record(ter_fmt.format(int(prev_line[6:11]) + 1, prev_line[17:20], prev_line[21],
+                                                prev_line[22:26], prev_line[26]))
+            line = line[:6] + str(int(line[6:11]) + serial_offset).rjust(5) + line[11:]
+            prev_line = line
+            yield pdb_record(line)
+    if prev_line is not None:
+        yield pdb_record(ter_fmt.format(int(prev_line[6:11]) + 1, prev_line[17:20], prev_line[21],
+                                        prev_line[22:26], prev_line[26]))
+
+
+def write_submission(output_pdb, header, pdb_l):
+    """ Write the submission in a single pass: template header with the CSB header right after the COMPND records,
+        then every PDB as a MODEL/ENDMDL block; only one record is held in memory at a time
+
+    :param output_pdb: Submission filename
+    :param header: Template header records
+    :param pdb_l: PDB filenames, in the order of the ensemble
+    :type output_pdb: string
+    :type header: list
+    :type pdb_l: list
+    """
+    compnd_end = max((idx + 1 for idx, line in enumerate(header) if line.startswith('COMPND')), default=0)
+    with open(output_pdb, 'w') as out_fh:
+        for line in header[:compnd_end]:
+            out_fh.write(pdb_record(line))
+        for line in csb_header().split('\n'):
+            out_fh.write(pdb_record(line))
+        for line in header[compnd_end:]:
+            out_fh.write(pdb_record(line))
+
+        for model_nb, pdb_f in enumerate(pdb_l, start=1):
+            out_fh.write(pdb_record(f'MODEL     {model_nb:>4}'))
+            out_fh.writelines(model_records(pdb_f))
+            out_fh.write(pdb_record('ENDMDL'))
+        out_fh.write(pdb_record('END'))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('run_path', help="Location of the run")
     parser.add_argument('template', help="Template provided by CAPRI")
+    parser.add_argument('--n_models', help='Number of models in the selection, default=100', type=int, default=100)
+    parser.add_argument('--n_clusters', help='Number of top clusters whose top 2 models are selected first, default=5', type=int, default=5)
+    parser.add_argument('--clusters', help='cluster.out to use instead of the one of the run, e.g. written by cluster_fcc.py')
+    parser.add_argument('--irmsd_cutoff', help='Fill the selection skipping the models within this interface-RMSD (Angstrom) of a model already selected, default=no redundancy removal', type=float)
+    parser.add_argument('--interface_cutoff', help=f'Distance cutoff in Angstrom defining the interface residues for --irmsd_cutoff, default={INTERFACE_CUTOFF}', type=float, default=INTERFACE_CUTOFF)
+    parser.add_argument('--np', help='Number of processors used to read and match the models', type=int, default=1)
+    parser.add_argument('--profile', help='Write the time, memory and throughput of every stage to this JSON file')
+    parser.add_argument('--cprofile', help='With --profile, dump the cProfile statistics of the matching to this file')
     args = parser.parse_args()
 
     if not os.path.isdir('selection'):
         os.mkdir('selection')
 
+    profiler = Profiler('prepare_submission', args.cprofile if args.profile else None)
+
     run_path = args.run_path
     # run_path = '/Users/rodrigo/repos/capri-r51-target183/runs/31349-nsp8-hexadeca-exosome'
 
-    template = args.template
+    # the template is parsed a single time per submission
+    with profiler.stage('read_template', 1):
+        template = Structure.from_pdb(args.template)
     # template = '/Users/rodrigo/repos/capri-r51-target183/capri_51_183.brk'
 
-    data = get_models(run_path)
-
-    # make this into a dataframe
-    df = pd.DataFrame(data, columns=['pdb', 'single_structure_ranking', 'overall_cluster_ranking', 'internal_cluster_ranking'])
-
-    # now select top10 cluster then fill until we reach 100
-    top1_top10_cluster = df[(df['overall_cluster_ranking'] <= 5) & (df['internal_cluster_ranking'] == 1)]['pdb']
-    top2_top10_cluster = df[(df['overall_cluster_ranking'] <= 5) & (df['internal_cluster_ranking'] == 2)]['pdb']
+    with profiler.stage('get_models') as stage:
+        data = get_models(run_path, args.clusters)
+        stage['items'] = len(data)
 
-    top10 = list(itertools.chain(*zip(top1_top10_cluster, top2_top10_cluster)))
+        # make this into a dataframe
+        df = pd.DataFrame(data, columns=['pdb', 'single_structure_ranking', 'overall_cluster_ranking', 'internal_cluster_ranking'])
 
-    # sort the dataframe by single-structure ranking and fill until we get 100 models
-    single_structure_sorted_df = df.sort_values(by='single_structure_ranking')
+    # now select the top2 of the top clusters then fill until we reach the selection size
+    fill = None
+    if args.irmsd_cutoff:
+        fill = functools.partial(remove_redundant, model_dir=f'{run_path}/structures/it1/water',
+                                 cutoff=args.irmsd_cutoff, interface_cutoff=args.interface_cutoff, nproc=args.np)
+    with profiler.stage('select_models', len(df)):
+        selection = select_models(df, n_clusters=args.n_clusters, n_models=args.n_models, fill=fill)
 
-    selection = copy.deepcopy(top10)
-
-    while len(selection) != 100:
-        for pdb in single_structure_sorted_df['pdb']:
-            if pdb not in selection:
-                selection.append(pdb)
-                break
-    
     with open('selection/selection.txt', 'w') as fh:
         for pdb in selection:
             fh.write(f'{run_path}/structures/it1/water/{pdb}\n')
     fh.close()
 
-    # =====================================================================================
-    #
-    # WARNING: This here is a hardcoded bypass specifically for CAPRI51 Target183
-    #
-    # =====================================================================================
-    renumbered_pdb_list = []
-    for pdb in selection:
-        output_pdb = f'selection/{pdb}'
-        intput_pdb = f'{run_path}/structures/it1/water/{pdb}'
-        with open(output_pdb, 'w') as out_fh:
-            with open(intput_pdb, 'r') as fh:
-                for line in fh.readlines():
-                    if line.startswith('ATOM'):
-                        chain = line[21]
-                        resnum = int(line[22:26])
-                        if chain == 'A':
-                            if resnum not in range(2282, 2397):
-                                line = line[:21] + '0' + line[22:]
-                            else:
-                                line = line[:21] + 'X' + line[22:]
-                        if chain == 'B':
-                            if resnum not in range(576, 845):
-                                line = line[:21] + '1' + line[22:]
-                            else:
-                                line = line[:21] + 'Y' + line[22:]
-                        out_fh.write(line)
-        out_fh.close()
-        renumbered_pdb_list.append(output_pdb)
-    # =====================================================================================
-                
-    matched_pdbs = match(renumbered_pdb_list, template)
+    # Rechaining (WARNING: hardcoded bypass specifically for CAPRI51 Target183, see capri51_rechain), chain
+    #  replacement and renumbering are applied in a single pass while copying each model into selection/
+    selected_pdb_list = [f'{run_path}/structures/it1/water/{pdb}' for pdb in selection]
+    with profiler.stage('match', len(selected_pdb_list), hot=True):
+        matched_pdbs = match(selected_pdb_list, template, 'selection', rechain=capri51_rechain, nproc=args.np,
+                             profiler=profiler)
 
     # logging.info(f'Creating HEADER')
-    header_str = ''
     permitted_records = ('HEADER', 'COMPND', 'SEQRES', 'REMARK')
-    with open(template) as fh:
-        for l in fh.readlines():
-            if l.startswith(permitted_records):
-                header_str += l
-            if l.startswith('MODEL'):
-                break
-
-    # logging.info(f'Creating the ensemble with pdb_mkensemble')
-    ensemble_f = create_ensemble(matched_pdbs, 'temp_ens.pdb')
-
-    logging.info('Merging HEADER with the ensemble')
-    submission_str = header_str
-    with open('temp_ens.pdb') as fh:
-        for l in fh.readlines():
-            if l.startswith('REMARK'):
-                continue
-            submission_str += l
+    header = [l for l in template.header if l.startswith(permitted_records)]
 
-    os.remove('temp_ens.pdb')
-
-    logging.info('Adding the CSB Header')
-    submission_str = add_csb_header(submission_str)
-    with open('selection/Target183_selection.pdb', 'w') as fh:
-        fh.write(submission_str)
-    fh.close()
+    logging.info('Writing the submission with the CSB header and the ensemble')
+    with profiler.stage('write_submission', len(matched_pdbs)):
+        write_submission('selection/Target183_selection.pdb', header, matched_pdbs)
 
-    logging.info('Adding TER with pdb_tidy')
-    finalized = tidy('selection/Target183_selection.pdb')
+    if args.profile:
+        logging.info(f'Writing the profile to {args.profile}')
+        profiler.write(args.profile)
 
     # done
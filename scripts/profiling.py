@@ -0,0 +1,184 @@
+# Stage-level profiling shared by the scripts: wall/CPU time, peak RSS, throughput and per-worker timings
+import contextlib
+import cProfile
+import glob
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import pstats
+import resource
+import sys
+import time
+
+_worker_profile = None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ Peak resident memory of the process (or of its finished children) so far, in MB """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def _init_worker(cprofile_f, initializer, initargs):
+    """ Pool initializer, the calls of the worker are profiled and the statistics dumped once, when it exits """
+    global _worker_profile
+    if initializer:
+        initializer(*initargs)
+    if cprofile_f:
+        _worker_profile = cProfile.Profile()
+        multiprocessing.util.Finalize(None, _worker_profile.dump_stats, args=(f'{cprofile_f}.{os.getpid()}',),
+                                      exitpriority=10)
+
+
+@contextlib.contextmanager
+def worker_pool(nproc, cprofile_f=None, initializer=None, initargs=()):
+    """ Process pool for TimedWorker calls, its workers are profiled when a cProfile file is given
+
+    On a normal exit the pool is closed and joined rather than terminated, so that the workers dump their statistics
+    to <cprofile_f>.<pid>, Profiler.write merges them.
+
+    :param nproc: Number of processes
+    :param cprofile_f: cProfile file of the Profiler, None to disable the profiling of the workers
+    :param initializer: Optional function called with initargs when every worker starts, e.g. to share data
+    :param initargs: Arguments of the initializer
+    :type nproc: int
+    :type cprofile_f: string
+    :type initializer: function
+    :type initargs: tuple
+    """
+    pool = multiprocessing.Pool(processes=nproc, initializer=_init_worker,
+                                initargs=(cprofile_f, initializer, initargs))
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+class TimedWorker:
+    """ Wrap a pool worker so every call also returns its timing
+
+    The timing is a dictionary with the pid, wall and CPU time of the call and the peak RSS of the worker. In the
+    workers of a worker_pool with profiling, the calls are also added to the profile of the worker.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        # the parent is profiled by Profiler.stage itself, it never has a worker profile
+        profile = _worker_profile
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            result = self.func(*args)
+        finally:
+            if profile:
+                profile.disable()
+        timing = {'pid': os.getpid(), 'wall_s': time.perf_counter() - start_wall,
+                  'cpu_s': time.process_time() - start_cpu, 'peak_rss_mb': peak_rss_mb()}
+        return result, timing
+
+
+class Profiler:
+    """ Collect the metrics of the stages of a script and write them as a JSON report
+
+    :ivar stages: One record per finished stage
+    :ivar cprofile_f: Where the cProfile statistics of the hot stage are dumped, None to disable it
+    """
+
+    def __init__(self, script, cprofile_f=None):
+        self.script = script
+        self.cprofile_f = cprofile_f
+        self.stages = []
+        self._current = None
+        if cprofile_f:
+            # leftovers of the workers of a previous run
+            for worker_f in glob.glob(f'{glob.escape(cprofile_f)}.*'):
+                os.remove(worker_f)
+        self._profiles = []
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None, hot=False):
+        """ Measure a stage, the yielded record can be updated inside it (for example its number of items)
+
+        :param name: Name of the stage
+        :param items: Number of items processed by the stage
+        :param hot: Whether the stage is profiled with cProfile (when a cProfile file was given)
+        :type name: string
+        :type items: int
+        :type hot: bool
+        """
+        record = {'stage': name, 'items': items}
+        self._current = {}
+        profile = cProfile.Profile() if hot and self.cprofile_f else None
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+                self._profiles.append(profile)
+            wall_s = time.perf_counter() - start_wall
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['wall_s'] = wall_s
+            record['cpu_s'] = time.process_time() - start_cpu
+            # only counts the worker processes that finished inside the stage
+            record['children_cpu_s'] = max(0., end_children.ru_utime + end_children.ru_stime
+                                           - start_children.ru_utime - start_children.ru_stime)
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['items_per_s'] = record['items'] / wall_s if record['items'] and wall_s else None
+            if self._current:
+                record['workers'] = sorted(self._current.values(), key=lambda worker: worker['pid'])
+            self._current = None
+            self.stages.append(record)
+
+    def worker_done(self, timing):
+        """ Add the timing of a call returned by a TimedWorker to the current stage """
+        worker = self._current.setdefault(timing['pid'], {'pid': timing['pid'], 'items': 0, 'wall_s': 0.,
+                                                          'cpu_s': 0., 'peak_rss_mb': 0.})
+        worker['items'] += 1
+        worker['wall_s'] += timing['wall_s']
+        worker['cpu_s'] += timing['cpu_s']
+        worker['peak_rss_mb'] = max(worker['peak_rss_mb'], timing['peak_rss_mb'])
+
+    def report(self):
+        """ The metrics of every stage plus the totals of the script """
+        return {'script': self.script, 'argv': sys.argv,
+                'wall_s': time.perf_counter() - self._start_wall, 'cpu_s': time.process_time() - self._start_cpu,
+                'peak_rss_mb': peak_rss_mb(), 'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+                'stages': self.stages}
+
+    def write(self, report_f):
+        """ Write the JSON report, and merge the cProfile statistics of the parent and the workers
+
+        :param report_f: JSON report filename
+        :type report_f: string
+        """
+        with open(report_f, 'w') as out_fh:
+            json.dump(self.report(), out_fh, indent=2)
+
+        if not self.cprofile_f:
+            return
+        worker_fs = glob.glob(f'{glob.escape(self.cprofile_f)}.*')
+        sources = self._profiles + worker_fs
+        if sources:
+            stats = pstats.Stats(*sources)
+            stats.dump_stats(self.cprofile_f)
+        for worker_f in worker_fs:
+            os.remove(worker_f)
@@ -0,0 +1,331 @@
+# Read the files of a HADDOCK run straight from its .tgz/.tar.gz/.tar archive or from gzipped files
+#
+# Paths are given as if the archive was a directory, e.g. runs/31349-nsp8-hexadeca-exosome.tgz/structures/it0/file.nam,
+#  for every path <path>.gz is tried as well. Files written for a run stored in an archive go to an overlay directory
+#  next to it (<archive>.d), which is also where they are read from afterwards. Models read in bulk are read by a
+#  single process in a single pass over the archive and handed to the workers with their contents, see
+#  map_run_files.
+import functools
+import gzip
+import io
+import json
+import logging
+import os
+import tarfile
+
+ARCHIVE_SUFFIXES = ('.tgz', '.tar.gz', '.tar')
+OVERLAY_SUFFIX = '.d'
+INDEX_NAME = 'archive-index.json'
+
+# member indexes are immutable and shared with forked workers, open handles are per process
+_indexes = {}
+_handles = {}
+# files of an archive read by another process and handed over with their contents, see _with_contents
+_preloaded = {}
+
+
+def split_archive_path(path):
+    """ Split a path that goes through a run archive
+
+    :param path: Path of a file of a run
+    :type path: string
+    :return: Archive filename and the path inside the archive, None if the path does not go through an archive
+    :rtype: tuple
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    for idx in range(len(parts) - 1, 0, -1):
+        archive_f = os.sep.join(parts[:idx]) or os.sep
+        if archive_f.endswith(ARCHIVE_SUFFIXES) and os.path.isfile(archive_f):
+            return archive_f, '/'.join(parts[idx:])
+    return None
+
+
+def _build_index(archive_f):
+    """ Offset and size of every file of an archive, in the uncompressed stream, plus the common top directory """
+    members = {}
+    with tarfile.open(archive_f, 'r:*') as tar:
+        for member in tar:
+            if member.isfile():
+                members[member.name] = (member.offset_data, member.size)
+            elif member.islnk() and member.linkname in members:
+                # hard links point to the data of a previous member
+                members[member.name] = members[member.linkname]
+    roots = set(name.split('/', 1)[0] for name in members if '/' in name)
+    root = roots.pop() if len(roots) == 1 and all('/' in name for name in members) else ''
+    return {'size': os.path.getsize(archive_f), 'mtime': os.path.getmtime(archive_f), 'root': root,
+            'members': members}
+
+
+def archive_index(archive_f):
+    """ Load the member index of an archive, it is built (reading the archive once) and saved the first time
+
+    :param archive_f: Archive filename
+    :type archive_f: string
+    :return: {'root': common top directory, 'members': {name: (offset, size)}}
+    :rtype: dict
+    """
+    if archive_f in _indexes:
+        return _indexes[archive_f]
+
+    index_f = os.path.join(archive_f + OVERLAY_SUFFIX, INDEX_NAME)
+    index = None
+    if os.path.isfile(index_f):
+        with open(index_f) as fh:
+            index = json.load(fh)
+        if index['size'] != os.path.getsize(archive_f) or index['mtime'] != os.path.getmtime(archive_f):
+            index = None
+
+    if index is None:
+        logging.info('Indexing the run archive %s', archive_f)
+        index = _build_index(archive_f)
+        try:
+            os.makedirs(os.path.dirname(index_f), exist_ok=True)
+            tmp_f = f'{index_f}.{os.getpid()}'
+            with open(tmp_f, 'w') as out_fh:
+                json.dump(index, out_fh)
+            os.replace(tmp_f, index_f)
+        except OSError as err:
+            logging.warning('Could not save the index of %s (%s), it will be rebuilt next time', archive_f, err)
+
+    _indexes[archive_f] = index
+    return index
+
+
+def _member(index, name):
+    for candidate in (name, f"{index['root']}/{name}"):
+        if candidate in index['members']:
+            return index['members'][candidate]
+    return None
+
+
+def _open_archive(archive_f):
+    return open(archive_f, 'rb') if archive_f.endswith('.tar') else gzip.open(archive_f, 'rb')
+
+
+def read_member(archive_f, name):
+    """ Read a file of an archive by its offset, without scanning the archive
+
+    Uncompressed .tar archives are read at random. A gzipped archive can only be decompressed forward: reading a
+    member before the last one read decompresses the archive again from its start, and every process decompresses it
+    on its own. The members of a gzipped archive are not stored in the order of file.nam either, models read in bulk
+    go through map_run_files instead.
+
+    :param archive_f: Archive filename
+    :param name: Path of the file inside the archive, relative to its top directory
+    :type archive_f: string
+    :type name: string
+    :return: The contents of the file, None if it is not in the archive
+    :rtype: bytes
+    """
+    location = _member(archive_index(archive_f), name)
+    if location is None:
+        return None
+    key = (archive_f, os.getpid())
+    if key not in _handles:
+        _handles[key] = _open_archive(archive_f)
+    handle = _handles[key]
+    offset, size = location
+    handle.seek(offset)
+    return handle.read(size)
+
+
+def _read_order(paths):
+    """ Order in which files of a run are read so every archive is read in a single forward pass
+
+    :param paths: Paths of files of a run
+    :type paths: list
+    :return: Indexes of the paths, first the files that are not in an archive, in order, then the archived files by
+        archive and offset
+    :rtype: list
+    """
+    on_disk, archived = [], []
+    for idx, path in enumerate(paths):
+        located = None if resolve_path(path) else split_archive_path(path)
+        location = None
+        if located:
+            archive_f, name = located
+            index = archive_index(archive_f)
+            location = _member(index, name) or _member(index, f'{name}.gz')
+        if location is None:
+            on_disk.append(idx)
+        else:
+            archived.append((archive_f, location[0], idx))
+    return on_disk + [idx for _, _, idx in sorted(archived)]
+
+
+def _iter_run_files(paths):
+    """ Read the files of a run that are only in its archive, each archive with a single handle
+
+    Given in the order of _read_order, every archive is decompressed once from start to end, with one member in
+    memory at a time. Files on disk are left to the process using them.
+
+    :param paths: Paths of files of a run
+    :type paths: list
+    :return: (path, contents) tuples, contents is None for files that are not in an archive
+    :rtype: generator
+    """
+    handles = {}
+    # hard links share the data of a member, they come one after the other
+    last_location, data = None, None
+    try:
+        for path in paths:
+            located = None if resolve_path(path) else split_archive_path(path)
+            if not located:
+                yield path, None
+                continue
+            archive_f, name = located
+            index = archive_index(archive_f)
+            for member, compressed in ((name, False), (f'{name}.gz', True)):
+                location = _member(index, member)
+                if location is not None:
+                    break
+            else:
+                yield path, None
+                continue
+            if (archive_f, location) != last_location:
+                if archive_f not in handles:
+                    handles[archive_f] = _open_archive(archive_f)
+                offset, size = location
+                handles[archive_f].seek(offset)
+                data = handles[archive_f].read(size)
+                last_location = (archive_f, location)
+            yield path, gzip.decompress(data) if compressed else data
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def _restore_order(order, results):
+    """ Yield results produced in the order of _read_order in the order of the paths instead, as soon as possible
+
+    :param order: Indexes returned by _read_order
+    :param results: Results in the order of order
+    :type order: list
+    :type results: iterable
+    :rtype: generator
+    """
+    pending = {}
+    next_idx = 0
+    for idx, result in zip(order, results):
+        pending[idx] = result
+        while next_idx in pending:
+            yield pending.pop(next_idx)
+            next_idx += 1
+
+
+def map_run_files(func, paths, imap=map):
+    """ Apply a function to files of a run, reading the archived ones in a single pass over their archive
+
+    The archived files are read by this process, in the order of their offset, and func gets them with their
+    contents: open_run_file serves them from memory, also in the workers of a pool. Files on disk are read by func
+    as usual.
+
+    :param func: Function of the path of a file, with imap=pool.imap it has to be picklable
+    :param paths: Paths of files of a run
+    :param imap: Lazy map function (function, iterable), e.g. the imap of a pool
+    :type func: function
+    :type paths: list
+    :type imap: function
+    :return: The results of func, in the order of paths, each one as soon as those before it are done
+    :rtype: generator
+    """
+    order = _read_order(paths)
+    items = _iter_run_files([paths[idx] for idx in order])
+    return _restore_order(order, imap(functools.partial(_with_contents, func), items))
+
+
+def _with_contents(func, item):
+    """ Call func with the path of a (path, contents) item of _iter_run_files, open_run_file reads it from contents """
+    path, contents = item
+    if contents is None:
+        return func(path)
+    _preloaded[path] = contents
+    try:
+        return func(path)
+    finally:
+        del _preloaded[path]
+
+
+def resolve_path(path):
+    """ Actual file behind a path of a run: the path itself or its overlay when the run is in an archive
+
+    :param path: Path of a file of a run
+    :type path: string
+    :return: Filename on disk (possibly ending in .gz), None if the file is not on disk
+    :rtype: string
+    """
+    candidates = [path]
+    located = split_archive_path(path)
+    if located:
+        archive_f, name = located
+        candidates.append(os.path.join(archive_f + OVERLAY_SUFFIX, name))
+    for candidate in candidates:
+        for filename in (candidate, f'{candidate}.gz'):
+            if os.path.isfile(filename):
+                return filename
+    return None
+
+
+def run_file_exists(path):
+    """ Whether a file of a run exists, on disk, gzipped or inside the run archive """
+    if path in _preloaded or resolve_path(path):
+        return True
+    located = split_archive_path(path)
+    if not located:
+        return False
+    index = archive_index(located[0])
+    return any(_member(index, name) for name in (located[1], f'{located[1]}.gz'))
+
+
+def open_run_file(path, mode='r'):
+    """ Open a file of a run for reading, on disk, gzipped or inside the run archive
+
+    :param path: Path of a file of a run
+    :param mode: 'r' or 'rb'
+    :type path: string
+    :type mode: string
+    :return: File object
+    :rtype: file
+    """
+    if path in _preloaded:
+        data = _preloaded[path]
+        return io.StringIO(data.decode('utf-8')) if mode == 'r' else io.BytesIO(data)
+
+    filename = resolve_path(path)
+    if filename:
+        if filename.endswith('.gz'):
+            return gzip.open(filename, 'rt' if mode == 'r' else 'rb')
+        return open(filename, mode)
+
+    located = split_archive_path(path)
+    if located:
+        archive_f, name = located
+        for member, compressed in ((name, False), (f'{name}.gz', True)):
+            data = read_member(archive_f, member)
+            if data is not None:
+                data = gzip.decompress(data) if compressed else data
+                return io.StringIO(data.decode('utf-8')) if mode == 'r' else io.BytesIO(data)
+    raise FileNotFoundError(path)
+
+
+def default_file_mode():
+    """ Permissions of a file created with open() under the current umask, tempfile.mkstemp uses 0600 instead """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def writable_path(path):
+    """ Where a file of a run is written, the overlay of the archive for runs in an archive
+
+    :param path: Path of a file of a run
+    :type path: string
+    :return: Filename on disk, its directory exists
+    :rtype: string
+    """
+    located = split_archive_path(path)
+    if located:
+        archive_f, name = located
+        path = os.path.join(archive_f + OVERLAY_SUFFIX, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
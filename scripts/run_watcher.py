@@ -0,0 +1,92 @@
+# Follow a stage of a HADDOCK run while the models are still being written
+#
+# The directory of the stage is polled: a model is handed out once it is complete, that is when it ends with the END
+#  record CNS writes last, or when it did not change for settle_s seconds (gzipped models). HADDOCK writes file.nam
+#  once the stage is over, the stage is finished when every model it lists was handed out.
+import os
+import re
+import time
+
+from haddock_files import read_file_nam
+
+MODEL_SUFFIXES = ('.pdb', '.pdb.gz')
+
+
+def model_number(pdb):
+    """ Sort key of the model names of a stage, complex_2.pdb comes before complex_10.pdb """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', pdb)]
+
+
+class ModelWatcher:
+    """ The models of a directory, handed out once as they are completely written
+
+    :ivar model_dir: Directory of the models, e.g. <run>/structures/it0
+    :ivar settle_s: Seconds a model without END record must stay unchanged to be complete
+    :ivar handed_out: Names of the models already handed out, as in file.nam
+    """
+
+    def __init__(self, model_dir, settle_s=30.):
+        self.model_dir = model_dir
+        self.settle_s = settle_s
+        self.handed_out = set()
+        # size and mtime of every incomplete model and since when they are the same
+        self._pending = {}
+
+    def _ends_with_end(self, model_f, size):
+        """ Whether the last record of a plain PDB file is END """
+        if model_f.endswith('.gz'):
+            return False
+        with open(model_f, 'rb') as fh:
+            fh.seek(max(size - 128, 0))
+            tail = fh.read().split(b'\n')
+        last = [line for line in tail if line.strip()]
+        return bool(last) and last[-1].startswith(b'END') and not last[-1].startswith(b'ENDMDL')
+
+    def _is_complete(self, model_f, stat):
+        now = time.time()
+        state = (stat.st_size, stat.st_mtime)
+        if self._pending.get(model_f, (None, now))[0] != state:
+            self._pending[model_f] = (state, now)
+        if stat.st_size and self._ends_with_end(model_f, stat.st_size):
+            return True
+        return now - self._pending[model_f][1] >= self.settle_s
+
+    def poll(self):
+        """ Names of the models completed since the last call, in the order of their number
+
+        :return: PDB names, as in file.nam
+        :rtype: list
+        """
+        completed = []
+        with os.scandir(self.model_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(MODEL_SUFFIXES) or not entry.is_file():
+                    continue
+                pdb = entry.name[:-len('.gz')] if entry.name.endswith('.gz') else entry.name
+                if pdb in self.handed_out:
+                    continue
+                try:
+                    if not self._is_complete(entry.path, entry.stat()):
+                        continue
+                except FileNotFoundError:
+                    # renamed while we were looking, e.g. when it gets gzipped
+                    continue
+                self._pending.pop(entry.path, None)
+                self.handed_out.add(pdb)
+                completed.append(pdb)
+        return sorted(completed, key=model_number)
+
+    def expected(self):
+        """ The models of the stage from its file.nam, None while the stage is running
+
+        :rtype: list
+        """
+        file_nam = os.path.join(self.model_dir, 'file.nam')
+        if not os.path.isfile(file_nam):
+            return None
+        return read_file_nam(file_nam)
+
+    def finished(self):
+        """ Whether the stage is over and all its models were handed out """
+        expected = self.expected()
+        return expected is not None and all(pdb in self.handed_out for pdb in expected)
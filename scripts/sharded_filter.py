@@ -0,0 +1,217 @@
+# Spread filter_contacts.py over several processes or compute nodes through a work queue on shared storage
+#
+#  init   split the models of file.nam into work units
+#  work   pull units from the queue until all of them are done, any number of workers can run on any node
+#  merge  combine the contacts and filter decisions of every unit into the contact store and filtered-pdbs.list
+#  local  init, a few local workers and merge, on a single machine
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+
+from contact_cache import DEFAULT_CACHE_DIR
+from contacts import DEFAULT_RADIUS, STORE_NAME, build_table, within_cutoff, write_store, load_store
+from filter_contacts import DEFAULT_FORBIDDEN, iter_contacts, load_forbidden, without_contacts, filter_contacts
+from haddock_files import read_file_nam
+from run_archive import writable_path
+from work_queue import WorkQueue
+
+CONFIG_NAME = 'queue.json'
+
+
+def init_queue(queue_dir, rundir, unit_size=500, cutoff=.2, forbidden_f=DEFAULT_FORBIDDEN, contact_cutoff=4.9,
+               radius=DEFAULT_RADIUS):
+    """Split the models of a run into work units of consecutive models of file.nam, returns the number of units."""
+    pdb_list = read_file_nam(f'{rundir}/structures/it0/file.nam')
+    os.makedirs(os.path.join(queue_dir, 'results'), exist_ok=True)
+    config = {'run_directory': os.path.abspath(rundir), 'cutoff': cutoff, 'contact_cutoff': contact_cutoff,
+              'radius': max(radius, contact_cutoff),
+              'forbidden': os.path.abspath(forbidden_f), 'models': len(pdb_list)}
+    with open(os.path.join(queue_dir, CONFIG_NAME), 'w') as out_fh:
+        json.dump(config, out_fh, indent=2)
+    units = WorkQueue(queue_dir).create([{'models': pdb_list[start:start + unit_size]}
+                                         for start in range(0, len(pdb_list), unit_size)])
+    return len(units)
+
+
+def load_config(queue_dir):
+    """Load the configuration a queue was created with."""
+    with open(os.path.join(queue_dir, CONFIG_NAME)) as fh:
+        return json.load(fh)
+
+
+def process_unit(config, pdb_list, nproc=1, cache_dir=None, renew=None):
+    """Calculate the contacts of the models of a unit and filter them, returns (names, table, filtered, failed)."""
+    it0 = f"{config['run_directory']}/structures/it0"
+    contacts = {}
+    failed = []
+    for (pdb_file, pairs, error), _ in iter_contacts([f'{it0}/{pdb}' for pdb in pdb_list], nproc,
+                                                     config['radius'], cache_dir):
+        if renew:
+            renew()
+        pdb = os.path.basename(pdb_file)
+        if pairs is False:
+            logging.warning('Could not calculate contacts for %s: %s', pdb, error or 'no contacts found')
+            failed.append(pdb)
+            continue
+        contacts[pdb] = pairs
+
+    # keep the order of file.nam, whatever the order the models finished in
+    names = [pdb for pdb in pdb_list if pdb in contacts]
+    table = build_table((idx, contacts[pdb]) for idx, pdb in enumerate(names))
+    contacts = within_cutoff(table, config['contact_cutoff'])
+    # residue pairs within the radius only: kept in the store, but the model failed, as in filter_contacts.py
+    for pdb in without_contacts(names, contacts):
+        logging.warning('Could not calculate contacts for %s: no contacts found', pdb)
+        failed.append(pdb)
+    filtered = filter_contacts(names, contacts, load_forbidden(config['forbidden']), config['cutoff'])
+    return names, table, filtered, [pdb for pdb in pdb_list if pdb in failed]
+
+
+def run_worker(queue_dir, worker, nproc=1, cache_dir=None, lease_s=300, max_attempts=3, poll_s=10):
+    """Process units of a queue until every unit is done or failed, returns the number of units processed."""
+    config = load_config(queue_dir)
+    queue = WorkQueue(queue_dir, lease_s, max_attempts)
+    processed = 0
+    while True:
+        unit = queue.claim(worker)
+        if unit is None:
+            if queue.finished():
+                return processed
+            # the remaining units are leased by other workers, wait in case one of them is abandoned
+            time.sleep(poll_s)
+            continue
+
+        pdb_list = queue.payload(unit)['models']
+        logging.info('Worker %s processing unit %s, %i models', worker, unit, len(pdb_list))
+        names, table, filtered, failed = process_unit(config, pdb_list, nproc, cache_dir,
+                                                      lambda: queue.renew(unit))
+
+        # the results are complete before the unit is marked as done
+        results_f = os.path.join(queue_dir, 'results', unit)
+        write_store(f'{results_f}.store', names, table, config['radius'])
+        tmp_f = f'{results_f}.{worker}.json'
+        with open(tmp_f, 'w') as out_fh:
+            json.dump({'filtered': filtered, 'failed': failed}, out_fh)
+        os.replace(tmp_f, f'{results_f}.json')
+        queue.complete(unit)
+        processed += 1
+
+
+def merge_results(queue_dir):
+    """Combine the results of every unit, in file.nam order, returns (names, table, filtered, failed, missing)."""
+    queue = WorkQueue(queue_dir)
+    names, tables, filtered, failed, missing = [], [build_table([])], [], [], []
+    for unit in queue.units():
+        if not queue.is_done(unit):
+            missing.append(unit)
+            failed += queue.payload(unit)['models']
+            continue
+        results_f = os.path.join(queue_dir, 'results', unit)
+        unit_names, table = load_store(f'{results_f}.store')
+        table = np.array(table)
+        table['model'] += len(names)
+        tables.append(table)
+        names += unit_names
+        with open(f'{results_f}.json') as fh:
+            decisions = json.load(fh)
+        filtered += decisions['filtered']
+        failed += decisions['failed']
+    return names, np.concatenate(tables), filtered, failed, missing
+
+
+def write_merged(queue_dir, output_f='filtered-pdbs.list'):
+    """Write the merged results like filter_contacts.py does: contact store, filtered list and failed list."""
+    config = load_config(queue_dir)
+    it0 = f"{config['run_directory']}/structures/it0"
+    names, table, filtered, failed, missing = merge_results(queue_dir)
+    if missing:
+        logging.warning('%i units were not processed (%s), their models are listed as failed', len(missing),
+                        ', '.join(missing))
+
+    store_f = f'{it0}/{STORE_NAME}'
+    logging.info('Writing the contacts of %i models to the contact store %s', len(names), store_f)
+    write_store(writable_path(store_f), names, table, config['radius'])
+
+    logging.info('%i of %i models passed the filter, writing them to %s', len(filtered), config['models'], output_f)
+    with open(output_f, 'w') as out_fh:
+        out_fh.write(''.join(f'{it0}/{pdb}\n' for pdb in filtered))
+    if failed:
+        logging.warning('%i models failed, see failed-pdbs.list', len(failed))
+        with open('failed-pdbs.list', 'w') as fail_fh:
+            fail_fh.write(''.join(f'{it0}/{pdb}\n' for pdb in failed))
+    return not missing
+
+
+def worker_args(args):
+    """Command line options of the work subcommand, for the workers started by the local subcommand."""
+    return ['--np', str(args.np), '--cache_dir', args.cache_dir, '--lease', str(args.lease),
+            '--max_attempts', str(args.max_attempts), '--poll', str(args.poll)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = argparse.ArgumentParser(add_help=False)
+    init_parser.add_argument("run_directory", help='Location of the run')
+    init_parser.add_argument("queue_dir", help='Directory of the work queue, on storage shared by all the workers')
+    init_parser.add_argument("--unit_size", help='Number of models per work unit, default=500', type=int, default=500)
+    init_parser.add_argument("--cutoff", help='Cutoff of forbidden contacts allowed in the PDB to be filtered, float between 0 and 1', type=float, default=.2)
+    init_parser.add_argument("--forbidden", help='JSON file with the forbidden regions as residue ranges', default=DEFAULT_FORBIDDEN)
+    init_parser.add_argument("--contact_cutoff", help='Distance cutoff in Angstrom used to define a contact', type=float, default=4.9)
+    init_parser.add_argument("--radius", help=f'Residue pairs are stored up to this distance in Angstrom, default={DEFAULT_RADIUS}', type=float, default=DEFAULT_RADIUS)
+
+    work_parser = argparse.ArgumentParser(add_help=False)
+    work_parser.add_argument("--np", help='Number of processors of each worker', type=int, default=2)
+    work_parser.add_argument("--cache_dir", help=f'Contact cache, default={DEFAULT_CACHE_DIR}', default=DEFAULT_CACHE_DIR)
+    work_parser.add_argument("--lease", help='Seconds without news after which the unit of a worker is given to another one, default=300', type=int, default=300)
+    work_parser.add_argument("--max_attempts", help='Number of times a unit is handed out before giving up on it, default=3', type=int, default=3)
+    work_parser.add_argument("--poll", help='Seconds between two looks at the queue while other workers finish, default=10', type=float, default=10)
+
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument("--output", help='Filtered models, default=filtered-pdbs.list', default='filtered-pdbs.list')
+
+    subparsers.add_parser('init', parents=[init_parser], help='Split the models of a run into work units')
+    worker_parser = subparsers.add_parser('work', parents=[work_parser], help='Process work units until the queue is empty')
+    worker_parser.add_argument("queue_dir", help='Directory of the work queue')
+    worker_parser.add_argument("--worker", help='Name of the worker, default=<host>-<pid>')
+    merge_parser = subparsers.add_parser('merge', parents=[output_parser], help='Combine the results of every unit')
+    merge_parser.add_argument("queue_dir", help='Directory of the work queue')
+    local_parser = subparsers.add_parser('local', parents=[init_parser, work_parser, output_parser],
+                                         help='Run init, several workers on this machine and merge')
+    local_parser.add_argument("--workers", help='Number of local workers, default=2', type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='DEBUG',
+                        format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    if args.command in ('init', 'local'):
+        n_units = init_queue(args.queue_dir, args.run_directory, args.unit_size, args.cutoff, args.forbidden,
+                             args.contact_cutoff, args.radius)
+        logging.info('Created %i work units in %s', n_units, args.queue_dir)
+
+    if args.command == 'work':
+        worker = args.worker or f'{socket.gethostname()}-{os.getpid()}'
+        n_units = run_worker(args.queue_dir, worker, args.np, args.cache_dir, args.lease, args.max_attempts, args.poll)
+        logging.info('Worker %s processed %i units, the queue is finished', worker, n_units)
+
+    if args.command == 'local':
+        # independent processes, exactly as workers started on other nodes would be
+        workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work', args.queue_dir,
+                                     '--worker', f'local-{idx}'] + worker_args(args))
+                   for idx in range(args.workers)]
+        if any([worker.wait() for worker in workers]):
+            logging.warning('Some of the workers failed')
+
+    if args.command in ('merge', 'local'):
+        if not write_merged(args.queue_dir, args.output):
+            sys.exit(1)
+
+    # done
@@ -0,0 +1,127 @@
+# PDB structure parsed once into NumPy arrays, shared by the submission helpers
+import numpy as np
+
+from run_archive import open_run_file
+
+ATOM_DTYPE = np.dtype([('chain', 'U1'), ('resnum', 'i4'), ('resname', 'U3'), ('name', 'U4'), ('xyz', 'f4', (3,))])
+
+AA_DIC = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLU': 'E', 'GLN': 'Q', 'GLY': 'G',
+          'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+          'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V', 'DC': 'C', 'DA': 'A', 'DG': 'G', 'DT': 'T',
+          'ADE': 'A', 'THY': 'T', 'GUA': 'G', 'CYT': 'C'}
+
+
+class Structure:
+    """ ATOM records of a PDB parsed once
+
+    :ivar header: Lines before the first ATOM or MODEL record
+    :ivar atom_lines: The ATOM records as they were read, used when writing
+    :ivar atoms: Structured array with chain, resnum, resname, name and xyz of every atom
+    :ivar residue_index: Residue index of every atom
+    :ivar residues: Structured array with chain, resnum and resname of every residue
+    :ivar chain_residues: {chain: residue indexes of the chain}
+    """
+
+    def __init__(self, header, atom_lines, atoms, residue_index=None):
+        self.header = header
+        self.atom_lines = atom_lines
+        self.atoms = atoms
+
+        if residue_index is None:
+            # a new residue starts whenever the chain or the residue number changes
+            first = np.ones(len(atoms), dtype=bool)
+            first[1:] = (atoms['chain'][1:] != atoms['chain'][:-1]) | (atoms['resnum'][1:] != atoms['resnum'][:-1])
+            residue_index = np.cumsum(first) - 1
+        else:
+            first = np.ones(len(atoms), dtype=bool)
+            first[1:] = residue_index[1:] != residue_index[:-1]
+        self.residue_index = residue_index
+        self.residues = np.array(atoms[['chain', 'resnum', 'resname']][first])
+        self.chain_residues = {chain: np.nonzero(self.residues['chain'] == chain)[0]
+                               for chain in np.unique(self.residues['chain']).tolist()}
+
+    @classmethod
+    def from_lines(cls, lines):
+        """ Parse the lines of a PDB
+
+        :param lines: Lines of a PDB file
+        :type lines: iterable
+        :rtype: Structure
+        """
+        header = []
+        atom_lines = []
+        records = []
+        in_header = True
+        for line in lines:
+            if line.startswith('ATOM'):
+                in_header = False
+                atom_lines.append(line)
+                records.append((line[21], int(line[22:26]), line[17:20].strip(), line[12:16].strip(),
+                                (float(line[30:38]), float(line[38:46]), float(line[46:54]))))
+            elif in_header:
+                if line.startswith('MODEL'):
+                    in_header = False
+                else:
+                    header.append(line)
+        return cls(header, atom_lines, np.array(records, dtype=ATOM_DTYPE))
+
+    @classmethod
+    def from_pdb(cls, pdb_f):
+        """ Read and parse a PDB file
+
+        :param pdb_f: PDB filename
+        :type pdb_f: string
+        :rtype: Structure
+        """
+        with open_run_file(pdb_f) as fh:
+            return cls.from_lines(fh)
+
+    def chain_ids(self):
+        """ Sorted chainIDs of the structure, numerical chains are ignored
+
+        :rtype: list
+        """
+        return sorted(chain.strip() for chain in self.chain_residues if not chain.strip().isdigit())
+
+    def sequence(self, chain):
+        """ Sequence of a chain, a residue number seen twice is counted once
+
+        :param chain: ChainID
+        :type chain: string
+        :return: Residue numbers and the one letter sequence
+        :rtype: tuple
+        """
+        residues = self.residues[self.chain_residues[chain]]
+        seq_dic = dict(zip(residues['resnum'].tolist(), (AA_DIC.get(r, 'X') for r in residues['resname'].tolist())))
+        return list(seq_dic), ''.join(seq_dic.values())
+
+    def with_chains(self, residue_chains):
+        """ Copy of the structure with new chainIDs, residues and the original ATOM records are kept as they are
+
+        :param residue_chains: New chainID of every residue
+        :type residue_chains: numpy.ndarray
+        :rtype: Structure
+        """
+        atoms = self.atoms.copy()
+        atoms['chain'] = np.asarray(residue_chains)[self.residue_index]
+        return Structure(self.header, self.atom_lines, atoms, self.residue_index)
+
+    def write(self, output_pdb, residue_chains, residue_resnums, keep):
+        """ Write the ATOM records with new chainIDs and residue numbers in a single pass
+
+        :param output_pdb: Output PDB filename
+        :param residue_chains: New chainID of every residue
+        :param residue_resnums: New residue number of every residue
+        :param keep: Whether each residue is written at all
+        :type output_pdb: string
+        :type residue_chains: numpy.ndarray
+        :type residue_resnums: numpy.ndarray
+        :type keep: numpy.ndarray
+        """
+        prefixes = [f'{chain}{resnum:>4}' if kept else None
+                    for chain, resnum, kept in zip(residue_chains.tolist(), residue_resnums.tolist(), keep.tolist())]
+        with open(output_pdb, 'w') as out_fh:
+            for line, res_idx in zip(self.atom_lines, self.residue_index.tolist()):
+                prefix = prefixes[res_idx]
+                if prefix is not None:
+                    out_fh.write(line[:21] + prefix + line[26:])
@@ -0,0 +1,214 @@
+# Generate a synthetic HADDOCK run directory, used to benchmark the scripts at scale
+import argparse
+import logging
+import os
+import shutil
+import numpy as np
+
+from contacts import read_atoms, atom_contacts, format_contacts
+
+INPUT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'input')
+
+
+def load_molecule(pdb_f, chain, shift=0, resrange=None):
+    """ Read the ATOM records of a molecule as a single chain
+
+    :param pdb_f: PDB filename
+    :param chain: ChainID given to every atom
+    :param shift: Added to every residue number
+    :param resrange: Optional inclusive (start, end) of the (shifted) residues that are kept
+    :type pdb_f: string
+    :type chain: string
+    :type shift: int
+    :type resrange: tuple
+    :return: ATOM records and their (n, 3) coordinates
+    :rtype: tuple
+    """
+    lines = []
+    with open(pdb_f) as fh:
+        for line in fh:
+            if not line.startswith('ATOM'):
+                continue
+            resnum = int(line[22:26]) + shift
+            if resrange and not resrange[0] <= resnum <= resrange[1]:
+                continue
+            lines.append(f'{line[:21]}{chain}{resnum:>4}{line[26:]}')
+    xyz = np.array([(float(l[30:38]), float(l[38:46]), float(l[46:54])) for l in lines]).reshape(-1, 3)
+    return lines, xyz
+
+
+def _unit(vector):
+    return vector / np.linalg.norm(vector)
+
+
+def random_pose(rng, xyz, center, distance):
+    """ Rotate a molecule randomly and place it at a given distance of a center in a random direction
+
+    :param rng: Random generator
+    :param xyz: (n, 3) coordinates
+    :param center: Point the molecule is placed around
+    :param distance: Distance between the center and the molecule
+    :type rng: numpy.random.Generator
+    :type xyz: numpy.ndarray
+    :type center: numpy.ndarray
+    :type distance: float
+    :return: New (n, 3) coordinates
+    :rtype: numpy.ndarray
+    """
+    a, b, c, d = _unit(rng.normal(size=4))
+    rotation = np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                         [2 * (b * c + a * d), a * a - b * b + c * c - d * d, 2 * (c * d - a * b)],
+                         [2 * (b * d - a * c), 2 * (c * d + a * b), a * a - b * b - c * c + d * d]])
+    return (xyz - xyz.mean(axis=0)) @ rotation.T + center + _unit(rng.normal(size=3)) * distance
+
+
+def write_model(pdb_f, mobile_lines, mobile_xyz, static_lines):
+    """ Write a model with the moved molecule first, as HADDOCK does
+
+    :param pdb_f: Output PDB filename
+    :param mobile_lines: ATOM records of the moved molecule
+    :param mobile_xyz: Its new coordinates
+    :param static_lines: ATOM records of the molecule that is not moved
+    :type pdb_f: string
+    :type mobile_lines: list
+    :type mobile_xyz: numpy.ndarray
+    :type static_lines: list
+    """
+    with open(pdb_f, 'w') as out_fh:
+        out_fh.write(f'REMARK FILENAME="{os.path.basename(pdb_f)}"\n')
+        for line, (x, y, z) in zip(mobile_lines, mobile_xyz.tolist()):
+            out_fh.write(f'{line[:30]}{x:8.3f}{y:8.3f}{z:8.3f}{line[54:]}')
+        out_fh.writelines(static_lines)
+        out_fh.write('END\n')
+
+
+def link(source_f, target_f):
+    """ Hard link a file, copy it if the filesystem does not support links """
+    if os.path.exists(target_f):
+        os.remove(target_f)
+    try:
+        os.link(source_f, target_f)
+    except OSError:
+        shutil.copyfile(source_f, target_f)
+
+
+def write_file_list(file_list, names, scores):
+    """ Write a HADDOCK file.list, models sorted by score """
+    with open(file_list, 'w') as out_fh:
+        for idx in np.argsort(scores, kind='stable').tolist():
+            out_fh.write(f'"PREVIT:{names[idx]}"  {{ {scores[idx]:.4f} }}\n')
+
+
+def make_it0(run_dir, n_models, n_poses, rng):
+    """ Write the it0 stage: Nsp7/Nsp8 placed around the exosome, with file.nam, file.list and .contacts files
+
+    Only n_poses distinct models are generated, the others are hard links to them so large runs stay cheap.
+
+    :param run_dir: Run directory
+    :param n_models: Number of models
+    :param n_poses: Number of distinct models
+    :param rng: Random generator
+    :type run_dir: string
+    :type n_models: int
+    :type n_poses: int
+    :type rng: numpy.random.Generator
+    """
+    it0 = os.path.join(run_dir, 'structures', 'it0')
+    os.makedirs(it0, exist_ok=True)
+    mobile_lines, mobile_xyz = load_molecule(os.path.join(INPUT_DIR, 'nsp8_A-nsp7_B.pdb'), 'A')
+    static_lines, static_xyz = load_molecule(os.path.join(INPUT_DIR, 'exosome.pdb'), 'B')
+    center = static_xyz.mean(axis=0)
+    # close enough to the center for the molecules to touch in most poses
+    distance = np.sqrt(((static_xyz - center) ** 2).sum(axis=1)).max() * 0.6
+
+    names = [f'complex_{idx + 1}.pdb' for idx in range(n_models)]
+    for idx, name in enumerate(names):
+        pdb_f = os.path.join(it0, name)
+        contact_f = pdb_f.replace('.pdb', '.contacts')
+        if idx < n_poses:
+            write_model(pdb_f, mobile_lines, random_pose(rng, mobile_xyz, center, distance), static_lines)
+            atoms, coords = read_atoms(pdb_f)
+            with open(contact_f, 'w') as out_fh:
+                out_fh.write(format_contacts(atoms, *atom_contacts(atoms, coords)))
+        else:
+            pose_f = os.path.join(it0, names[idx % n_poses])
+            link(pose_f, pdb_f)
+            link(pose_f.replace('.pdb', '.contacts'), contact_f)
+        if (idx + 1) % 1000 == 0:
+            logging.info('it0: %i/%i models written', idx + 1, n_models)
+
+    with open(os.path.join(it0, 'file.nam'), 'w') as out_fh:
+        out_fh.write(''.join(f'{name}\n' for name in names))
+    write_file_list(os.path.join(it0, 'file.list'), names, rng.normal(-50, 20, n_models))
+
+
+def make_water(run_dir, n_models, n_poses, rng):
+    """ Write the it1/water stage: the hexadecamer placed around the exosome, with file.list and analysis/cluster.out
+
+    Only the hexadecamer and exosome residues covered by the CAPRI template are kept to keep the models small.
+
+    :param run_dir: Run directory
+    :param n_models: Number of models
+    :param n_poses: Number of distinct models
+    :param rng: Random generator
+    :type run_dir: string
+    :type n_models: int
+    :type n_poses: int
+    :type rng: numpy.random.Generator
+    """
+    water = os.path.join(run_dir, 'structures', 'it1', 'water')
+    os.makedirs(os.path.join(water, 'analysis'), exist_ok=True)
+    mobile_lines, mobile_xyz = load_molecule(os.path.join(INPUT_DIR, 'hexadecamer_nsp7-8.pdb'), 'A',
+                                             resrange=(2200, 2397))
+    static_lines, static_xyz = load_molecule(os.path.join(INPUT_DIR, 'exosome.pdb'), 'B', shift=38,
+                                             resrange=(450, 900))
+    center = static_xyz.mean(axis=0)
+    # close enough to the center for the molecules to touch in most poses
+    distance = np.sqrt(((static_xyz - center) ** 2).sum(axis=1)).max() * 0.6
+
+    names = [f'complex_{idx + 1}w.pdb' for idx in range(n_models)]
+    for idx, name in enumerate(names):
+        pdb_f = os.path.join(water, name)
+        if idx < n_poses:
+            write_model(pdb_f, mobile_lines, random_pose(rng, mobile_xyz, center, distance), static_lines)
+        else:
+            link(os.path.join(water, names[idx % n_poses]), pdb_f)
+
+    with open(os.path.join(water, 'file.nam'), 'w') as out_fh:
+        out_fh.write(''.join(f'{name}\n' for name in names))
+    scores = rng.normal(-50, 20, n_models)
+    write_file_list(os.path.join(water, 'file.list'), names, scores)
+
+    # clusters of 4 to 6 models, the elements are positions in file.list (1-based), the first one is the center
+    elements = rng.permutation(n_models) + 1
+    with open(os.path.join(water, 'analysis', 'cluster.out'), 'w') as out_fh:
+        start = 0
+        cluster_id = 1
+        while start + 4 <= len(elements):
+            size = int(rng.integers(4, 7))
+            members = sorted(elements[start:start + size].tolist())
+            start += size
+            out_fh.write(f'Cluster {cluster_id} -> {members[0]} ' + ' '.join(map(str, members)) + ' \n')
+            cluster_id += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_directory", help='Where the synthetic run is written')
+    parser.add_argument("--models", help='Number of it0 models, default=1000', type=int, default=1000)
+    parser.add_argument("--water", help='Number of it1/water models, default=200', type=int, default=200)
+    parser.add_argument("--poses", help='Number of distinct models per stage, the rest are hard links, default=100', type=int, default=100)
+    parser.add_argument("--seed", help='Random seed, default=0', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='DEBUG',
+                        format='%(asctime)s L%(lineno)d %(levelname)s - %(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+
+    rng = np.random.default_rng(args.seed)
+    logging.info('Writing %i it0 models (%i distinct) to %s', args.models, min(args.poses, args.models), args.run_directory)
+    make_it0(args.run_directory, args.models, args.poses, rng)
+    logging.info('Writing %i it1/water models (%i distinct)', args.water, min(args.poses, args.water))
+    make_water(args.run_directory, args.water, args.poses, rng)
+
+    # done
@@ -0,0 +1,173 @@
+# Work queue kept as plain files on shared storage, so workers on any number of nodes can pull units from it
+#
+# <queue_dir>/units/<unit>.json   payload of every unit, written once when the queue is created
+# <queue_dir>/leases/<unit>       the worker processing a unit, its mtime is refreshed while the worker is alive
+# <queue_dir>/attempts/<unit>.<n> the record of the n-th time a unit was handed out, a worker only leases a unit after
+#                                  creating the next record, so concurrent claims never share nor reset an attempt
+# <queue_dir>/done/<unit>         a unit whose results are complete
+# <queue_dir>/failed/<unit>       a unit abandoned more than max_attempts times, it is not handed out anymore
+#
+# Files are created with os.link, which is atomic and exclusive also on NFS, and a lease that is not refreshed for
+#  lease_s seconds is taken over by the next worker asking for work.
+import json
+import os
+import time
+import uuid
+
+UNIT_DIRS = ('units', 'leases', 'attempts', 'done', 'failed')
+
+
+class WorkQueue:
+    """ A queue of work units on a shared filesystem, with leases and retry of abandoned units
+
+    :ivar queue_dir: Directory of the queue
+    :ivar lease_s: Seconds after which a lease that was not renewed is considered abandoned
+    :ivar max_attempts: Number of times a unit is handed out before it is marked as failed
+    """
+
+    def __init__(self, queue_dir, lease_s=300, max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+
+    def _path(self, kind, unit):
+        return os.path.join(self.queue_dir, kind, unit)
+
+    def _create(self, path, content):
+        """ Create a file with its content in place, False if it already exists """
+        tmp_f = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_f, 'w') as out_fh:
+            out_fh.write(content)
+        try:
+            os.link(tmp_f, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_f)
+
+    def create(self, payloads):
+        """ Create the queue with one unit per payload, units are named by their position
+
+        :param payloads: JSON-serializable payload of every unit
+        :type payloads: list
+        :return: Unit names
+        :rtype: list
+        """
+        for kind in UNIT_DIRS:
+            os.makedirs(os.path.join(self.queue_dir, kind), exist_ok=True)
+        units = [f'{idx:06d}' for idx in range(len(payloads))]
+        for unit, payload in zip(units, payloads):
+            if not self._create(self._path('units', f'{unit}.json'), json.dumps(payload)):
+                raise FileExistsError(f'{self.queue_dir} already has a unit {unit}')
+        return units
+
+    def units(self):
+        """ Names of all the units of the queue, in order """
+        return sorted(unit_f[:-len('.json')] for unit_f in os.listdir(os.path.join(self.queue_dir, 'units'))
+                      if unit_f.endswith('.json'))
+
+    def payload(self, unit):
+        """ Payload of a unit """
+        with open(self._path('units', f'{unit}.json')) as fh:
+            return json.load(fh)
+
+    def is_done(self, unit):
+        return os.path.exists(self._path('done', unit))
+
+    def is_failed(self, unit):
+        return os.path.exists(self._path('failed', unit))
+
+    def _release_stale(self, unit):
+        """ Move the lease of a unit away if it was abandoned, returns whether the unit has no live lease """
+        lease_f = self._path('leases', unit)
+        try:
+            if time.time() - os.path.getmtime(lease_f) <= self.lease_s:
+                return False
+            # only one of the workers noticing the abandoned lease manages to move it away, all of them then race
+            #  for the next attempt record
+            stale_f = f'{lease_f}.{uuid.uuid4().hex}.stale'
+            os.rename(lease_f, stale_f)
+            os.remove(stale_f)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def attempts(self, unit):
+        """ Number of times a unit was handed out """
+        attempt = 0
+        while os.path.exists(self._path('attempts', f'{unit}.{attempt + 1}')):
+            attempt += 1
+        return attempt
+
+    def claim(self, worker):
+        """ Lease the next unit that is not done, nor leased by a live worker
+
+        :param worker: Name of the worker, for the record
+        :type worker: string
+        :return: Name of the leased unit, None if there is nothing to do right now
+        :rtype: string
+        """
+        for unit in self.units():
+            if self.is_done(unit) or self.is_failed(unit):
+                continue
+            # counted before looking at the lease, a worker releasing a stale lease races with the workers that
+            #  find the unit free for the same attempt
+            attempt = self.attempts(unit) + 1
+            lease_f = self._path('leases', unit)
+            if os.path.exists(lease_f) and not self._release_stale(unit):
+                continue
+            if attempt > self.max_attempts:
+                self._create(self._path('failed', unit), json.dumps({'attempts': attempt - 1}))
+                continue
+            record = json.dumps({'worker': worker, 'attempt': attempt, 'claimed': time.time()})
+            if not self._create(self._path('attempts', f'{unit}.{attempt}'), record):
+                # another worker got this attempt
+                continue
+            if self.is_done(unit):
+                # completed by the previous worker while we were looking
+                continue
+            if not self._create(lease_f, record):
+                # a worker that counted our attempt leased the unit first, our record still counts as an attempt
+                continue
+            return unit
+        return None
+
+    def renew(self, unit):
+        """ Refresh the lease of a unit, tells the other workers its worker is still alive """
+        try:
+            os.utime(self._path('leases', unit))
+        except FileNotFoundError:
+            # taken over by another worker, both finish it and the results are the same
+            pass
+
+    def complete(self, unit):
+        """ Mark a unit as done, once its results are written, and release its lease """
+        self._create(self._path('done', unit), json.dumps({'completed': time.time()}))
+        try:
+            os.remove(self._path('leases', unit))
+        except FileNotFoundError:
+            pass
+
+    def status(self):
+        """ Number of units done, failed, leased and waiting
+
+        :return: {state: number of units}
+        :rtype: dict
+        """
+        counts = dict.fromkeys(('done', 'failed', 'leased', 'waiting'), 0)
+        for unit in self.units():
+            if self.is_done(unit):
+                counts['done'] += 1
+            elif self.is_failed(unit):
+                counts['failed'] += 1
+            elif os.path.exists(self._path('leases', unit)):
+                counts['leased'] += 1
+            else:
+                counts['waiting'] += 1
+        return counts
+
+    def finished(self):
+        """ Whether every unit is either done or failed """
+        counts = self.status()
+        return not counts['leased'] and not counts['waiting']
@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from contact_analysis import rank_models
+
+
+def test_top_models_are_the_best_filtered():
+    haddockscore_dic = {'complex_1.pdb': -10., 'complex_2.pdb': -50., 'complex_3.pdb': -30., 'complex_4.pdb': -40.,
+                        'complex_10.pdb': -60.}
+    # complex_10.pdb has the best score but did not pass the filter
+    filtered = ['run/complex_1.pdb', 'run/complex_2.pdb', 'run/complex_3.pdb', 'run/complex_4.pdb']
+
+    assert rank_models(filtered, haddockscore_dic, 2) == ['run/complex_2.pdb', 'run/complex_4.pdb']
+    assert rank_models(filtered, haddockscore_dic, 10) == ['run/complex_2.pdb', 'run/complex_4.pdb',
+                                                           'run/complex_3.pdb', 'run/complex_1.pdb']
+
+
+def test_ties_keep_the_filtered_order():
+    haddockscore_dic = {'complex_1.pdb': -10., 'complex_2.pdb': -20., 'complex_3.pdb': -20.}
+    filtered = ['run/complex_3.pdb', 'run/complex_1.pdb', 'run/complex_2.pdb']
+
+    assert rank_models(filtered, haddockscore_dic, 2) == ['run/complex_3.pdb', 'run/complex_2.pdb']
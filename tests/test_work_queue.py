@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from work_queue import WorkQueue
+
+
+class RacingQueue(WorkQueue):
+    """ Lets a rival worker claim right after this worker created its attempt record, before it leases the unit """
+
+    def __init__(self, queue_dir):
+        super().__init__(queue_dir)
+        self.rival_unit = None
+        self._raced = False
+
+    def is_done(self, unit):
+        if not self._raced and self.attempts(unit):
+            self._raced = True
+            self.rival_unit = WorkQueue(self.queue_dir).claim('B')
+        return super().is_done(unit)
+
+
+def test_claim_race(tmp_path):
+    queue = RacingQueue(str(tmp_path))
+    queue.create([{'pdbs': ['complex_1.pdb']}])
+
+    # B got the lease first, A must not process the unit as well
+    assert queue.claim('A') is None
+    assert queue.rival_unit == '000000'
+    assert queue.claim('C') is None
+
+
+def test_claim_once(tmp_path):
+    queue = WorkQueue(str(tmp_path))
+    queue.create([{'pdbs': ['complex_1.pdb']}, {'pdbs': ['complex_2.pdb']}])
+
+    assert queue.claim('A') == '000000'
+    assert queue.claim('B') == '000001'
+    assert queue.claim('C') is None
+    assert queue.attempts('000000') == queue.attempts('000001') == 1